@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from my_io import read_workbook
+from my_funct import run_aging_provision_pipeline, get_GL_entry, check_parameters
+
+# Headless month-end runner: one provision run per SOH file in a manifest, spread over a
+# process pool. The manifest is a CSV with columns name, soh_path and optionally
+# balance_path (existing balances for the GL diff entry).
+
+# mapping and combinations are parsed once in the parent and handed to each worker process
+# a single time through the pool initializer, not once per run
+_shared = {}
+
+def _init_worker(mapping, combinations):
+    _shared["mapping"] = mapping
+    _shared["combinations"] = combinations
+
+def read_manifest(manifest_path):
+    manifest = pd.read_csv(manifest_path, dtype=str).fillna('')
+    missing = {'name', 'soh_path'} - set(manifest.columns)
+    if missing:
+        raise ValueError(f"Manifest is missing columns: {sorted(missing)}")
+    if 'balance_path' not in manifest.columns:
+        manifest['balance_path'] = ''
+    if manifest['name'].duplicated().any():
+        raise ValueError("Manifest run names must be unique")
+    return manifest.to_dict('records')
+
+def run_entry(entry, parameters, output_dir):
+    results = run_aging_provision_pipeline(
+        entry['soh_path'], _shared["mapping"], _shared["combinations"], **parameters)
+    run_dir = os.path.join(output_dir, entry['name'])
+    os.makedirs(run_dir, exist_ok=True)
+    results["summary"].to_csv(os.path.join(run_dir, "summary.csv"))
+    results["cube"].to_csv(os.path.join(run_dir, "cube.csv"), index=False)
+
+    if entry.get('balance_path'):
+        existing_balances = pd.read_excel(entry['balance_path'])
+    else:
+        existing_balances = pd.DataFrame({c: pd.Series(dtype=float) for c in ['s1', 's2', 's3', 's4', 'Closing balance']})
+    completed_entry, diff_entry, _ = get_GL_entry(results["cube"], existing_balances)
+    completed_entry.to_csv(os.path.join(run_dir, "completed_entry.csv"), index=False)
+    if entry.get('balance_path'):
+        diff_entry.to_csv(os.path.join(run_dir, "diff_entry.csv"), index=False)
+    return entry['name'], results["summary"]
+
+def run_batch(manifest, mapping, combinations, parameters=None, output_dir=os.path.join("Output", "batch"),
+              max_workers=None):
+    # manifest: path to the manifest CSV or a list of {"name", "soh_path", "balance_path"} dicts
+    parameters = check_parameters(parameters)
+    entries = read_manifest(manifest) if isinstance(manifest, str) else manifest
+    mapping = read_workbook(mapping, "mapping")
+    combinations = read_workbook(combinations, "combinations")
+    os.makedirs(output_dir, exist_ok=True)
+
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(mapping, combinations)) as pool:
+        futures = [pool.submit(run_entry, entry, parameters, output_dir) for entry in entries]
+        for future in as_completed(futures):
+            name, summary = future.result()
+            summaries[name] = summary
+
+    consolidated = pd.concat(
+        {entry['name']: summaries[entry['name']] for entry in entries}, names=['run'])
+    consolidated.to_csv(os.path.join(output_dir, "consolidated_summary.csv"))
+    return consolidated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the aging provision for every SOH file in a manifest.")
+    parser.add_argument("manifest", help="CSV with columns name, soh_path[, balance_path]")
+    parser.add_argument("--mapping", default="mapping.xlsx")
+    parser.add_argument("--combinations", default="combinations.xlsx")
+    parser.add_argument("--params", help="JSON file with pipeline parameters")
+    parser.add_argument("--output", default=os.path.join("Output", "batch"))
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    parameters = {}
+    if args.params:
+        with open(args.params) as f:
+            parameters = json.load(f)
+    consolidated = run_batch(args.manifest, args.mapping, args.combinations, parameters,
+                             output_dir=args.output, max_workers=args.workers)
+    print(consolidated.groupby(level='run')[['NETTOTAL_COST', 'Total Provision']].sum())
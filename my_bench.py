@@ -0,0 +1,277 @@
+import argparse
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from my_funct import (standardize_season, standardize_seasons, _season_cache, prepare_aging_inputs,
+                      apply_provision_parameters, run_aging_provision_pipeline_chunked, get_analysis, get_GL_entry)
+from my_incremental import run_incremental_provision
+from my_io import read_workbook
+from my_parallel import run_aging_provision_pipeline_parallel
+from my_trace import PipelineTrace
+
+# Synthetic data and timings for the provision pipeline.
+#   python my_bench.py                      10k and 1M rows, checked against bench_golden/
+#   python my_bench.py --rows 10000000      the 10M run (needs several GB of RAM)
+#   python my_bench.py --update-golden      rewrite the golden outputs (only when totals are meant to change)
+#   python my_bench.py --paths serial       only some of the pipeline paths (default: all of them)
+# Every path is checked against the same golden outputs, written from the serial path.
+
+BENCH_SIZES = (10_000, 1_000_000)
+BENCH_PATHS = ("serial", "chunked", "parallel-brand", "parallel-rows", "incremental")
+GOLDEN_DIR = "bench_golden"
+BENCH_PARAMETERS = dict(
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.50,
+    closed_percentage=0.50,
+    brand_specific_provision={},
+    unknown_season_in_bucket1=True
+)
+
+SEASON_DESCS = [
+    "AW25", "SS25", "Spring Summer 2024", "AUTUMN WINTER 2023", "SS 23", "aw22", "WA21",
+    "Continuity", "BASICS", "OLD SEASON", "2019", "FW 20", "Winter 2020", "Summer 2022",
+    "AW97", "", None,
+]
+# recent seasons hold most of the stock, old and garbage seasons a long tail
+SEASON_WEIGHTS = [14, 14, 11, 9, 7, 5, 3, 6, 4, 2, 2, 3, 3, 4, 1, 1, 1]
+
+# suffixes drive location_category (see LOCATION_PATTERNS): mostly stores, some leftover/damage
+LOCATION_SUFFIXES = [" Store", " Online", " Leftover WH", " Damage Room", " Sulay DC"]
+LOCATION_WEIGHTS = [80, 5, 8, 5, 2]
+
+def synthetic_seasons(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.Series(rng.choice(np.array(SEASON_DESCS, dtype=object), n_rows))
+
+def _weights(values):
+    weights = np.asarray(values, dtype=float)
+    return weights / weights.sum()
+
+def synthetic_soh(n_rows, mapping, combinations, seed=0):
+    # SOH rows drawn from the real mapping and combinations files, so Model and Closed_status
+    # follow the mapping and most (brand, location) pairs have a segment combination.
+    # Brand sizes are Zipf-like; ~1% of rows have no mapping, ~3% no combination.
+    rng = np.random.default_rng(seed)
+    mapping = read_workbook(mapping, "mapping")
+    combinations = read_workbook(combinations, "combinations")
+
+    group_names = mapping['GROUP_NAME'].astype(str).to_numpy()
+    brand_of_group = mapping['Std Brand'].to_numpy()
+    brand_weights = _weights(1 / np.arange(1, len(group_names) + 1) ** 0.8)
+    group = rng.choice(len(group_names), n_rows, p=brand_weights)
+
+    # each row's location is one of its brand's combination locations
+    combinations = combinations.sort_values('Std Brand', kind='stable')
+    brand_codes, brands = pd.factorize(combinations['Std Brand'])
+    starts = np.searchsorted(brand_codes, np.arange(len(brands)))
+    counts = np.bincount(brand_codes, minlength=len(brands))
+    row_brand = brands.get_indexer(brand_of_group[group])
+    has_locations = (row_brand >= 0) & (rng.random(n_rows) >= 0.03)
+    locations = combinations['LOCATION'].to_numpy()
+    picked = starts[row_brand[has_locations]] + (rng.random(has_locations.sum()) * counts[row_brand[has_locations]]).astype(int)
+    location = rng.choice(locations, n_rows)
+    location[has_locations] = locations[picked]
+
+    names = np.where(rng.random(n_rows) < 0.5, np.char.title(group_names[group].astype(str)), group_names[group])
+    names = names.astype(object)
+    names[rng.random(n_rows) < 0.01] = "Unmapped Co"
+    names[rng.random(n_rows) < 0.005] = "Aleph"
+
+    cost = np.round(rng.lognormal(4.0, 1.2, n_rows), 2)
+    cost[rng.random(n_rows) < 0.005] = 0
+    cost[rng.random(n_rows) < 0.01] = np.nan
+
+    suffix = np.array(LOCATION_SUFFIXES, dtype=object)[rng.choice(len(LOCATION_SUFFIXES), n_rows, p=_weights(LOCATION_WEIGHTS))]
+    return pd.DataFrame({
+        'GROUP_NAME': names,
+        'LOCATION': location,
+        'LOCATION_NAME': location.astype(str).astype(object) + suffix,
+        'ITEM': rng.integers(1, 200_000, n_rows),
+        'SEASON_DESC': rng.choice(np.array(SEASON_DESCS, dtype=object), n_rows, p=_weights(SEASON_WEIGHTS)),
+        'NETTOTAL_COST': cost,
+        'AR Comments': np.where(rng.random(n_rows) < 0.9, 'Consider', 'Ignore').astype(object),
+    })
+
+def synthetic_mapping(mapping):
+    # the mapping with one GROUP_NAME listed again and another listed again in title case (the
+    # two only collide after upper-casing), each under another Std Brand: real mapping files
+    # carry such rows, which repeat the SOH rows they match and show up as duplicates_mapping
+    mapping = read_workbook(mapping, "mapping")
+    extra = mapping.iloc[[3, 2]].copy()
+    extra['GROUP_NAME'] = [mapping['GROUP_NAME'].iloc[0], mapping['GROUP_NAME'].iloc[1].title()]
+    return pd.concat([mapping, extra], ignore_index=True)
+
+def synthetic_balances(combinations, seed=0):
+    # closing balances for ~80% of the segments, credit side like the ledger export
+    rng = np.random.default_rng(seed)
+    segments = read_workbook(combinations, "combinations")[['s1', 's2', 's3', 's4']].drop_duplicates()
+    segments = segments[rng.random(len(segments)) < 0.8].reset_index(drop=True)
+    segments['Closing balance'] = -np.round(rng.lognormal(7.0, 1.5, len(segments)), 2)
+    return segments
+
+def previous_soh(soh):
+    # the month before for the incremental path: every 100th row not there yet and every 50th
+    # at another cost, so the run provisions a few percent of the rows on top of the stored state
+    previous = soh.drop(index=soh.index[::100]).copy()
+    previous.loc[previous.index[::50], 'NETTOTAL_COST'] *= 2
+    return previous
+
+def _run_path(path, soh, mapping, combinations, directory, trace):
+    # (results, seconds) of one pipeline path; setup such as the incremental state is not timed
+    if path == "incremental":
+        state_dir = os.path.join(directory, "state")
+        run_incremental_provision(previous_soh(soh), mapping, combinations, state_dir, **BENCH_PARAMETERS)
+        _season_cache.clear()
+    elif path == "chunked":
+        soh_path = os.path.join(directory, "soh.parquet")
+        soh.to_parquet(soh_path, index=False)
+
+    start = time.perf_counter()
+    if path == "serial":
+        prepared = prepare_aging_inputs(soh, mapping, combinations, trace=trace)
+        results = apply_provision_parameters(prepared, **BENCH_PARAMETERS, trace=trace)
+    elif path == "chunked":
+        # a quarter of the rows per chunk, so every size streams several chunks
+        results = run_aging_provision_pipeline_chunked(soh_path, mapping, combinations, **BENCH_PARAMETERS,
+                                                       chunksize=max(len(soh) // 4, 1), trace=trace)
+    elif path in ("parallel-brand", "parallel-rows"):
+        results = run_aging_provision_pipeline_parallel(soh, mapping, combinations, **BENCH_PARAMETERS,
+                                                        partition_by=path.split("-")[1], trace=trace)
+    elif path == "incremental":
+        results = run_incremental_provision(soh, mapping, combinations, state_dir, **BENCH_PARAMETERS, trace=trace)
+        if results["mode"] != "incremental":
+            raise RuntimeError("the incremental path fell back to a full run")
+    else:
+        raise ValueError(f"Unknown pipeline path {path!r}, expected one of {BENCH_PATHS}")
+    return results, time.perf_counter() - start
+
+def bench_pipeline(n_rows, mapping="mapping.xlsx", combinations="combinations.xlsx", seed=0, track_memory=False,
+                   path="serial"):
+    # returns the per-stage trace plus the outputs compared against the golden files
+    soh = synthetic_soh(n_rows, mapping, combinations, seed)
+    balances = synthetic_balances(combinations, seed)
+    mapping = synthetic_mapping(mapping)
+    _season_cache.clear()
+
+    trace = PipelineTrace(track_memory=track_memory)
+    with tempfile.TemporaryDirectory(prefix="bench-") as directory:
+        results, pipeline_time = _run_path(path, soh, mapping, combinations, directory, trace)
+    start = time.perf_counter()
+    analysis = get_analysis(results["cube"], results["mapping"], trace)
+    completed_entry, diff_entry, _ = get_GL_entry(results["cube"], balances, trace)
+    trace.stop()
+
+    return {
+        "rows": n_rows,
+        "path": path,
+        "pipeline_s": pipeline_time,
+        "total_s": pipeline_time + time.perf_counter() - start,
+        "stages": trace.to_frame(),
+        "outputs": golden_outputs(results, analysis, completed_entry, diff_entry),
+    }
+
+def golden_outputs(results, analysis, completed_entry, diff_entry):
+    totals = pd.DataFrame([{
+        "Total Provision": results["summary"]["Total Provision"].sum(),
+        "NETTOTAL_COST": results["summary"]["NETTOTAL_COST"].sum(),
+        "missing_in_std_brand": analysis["missing_in_std_brand"],
+        "missing_comb_rows": analysis["missing_comb_rows"],
+        "duplicates_mapping": analysis["duplicates_mapping"],
+    }])
+    summary = results["summary"].reset_index()
+    summary['Std Brand'] = summary['Std Brand'].astype(str)
+    sort_gl = lambda df: df.sort_values(['s1', 's2', 's3', 's4', 's5']).reset_index(drop=True)
+    return {
+        "totals": totals,
+        "summary": summary,
+        "completed_entry": sort_gl(completed_entry),
+        "diff_entry": sort_gl(diff_entry),
+    }
+
+def _golden_path(n_rows, seed, name):
+    return os.path.join(GOLDEN_DIR, f"{n_rows}_seed{seed}", f"{name}.csv")
+
+def write_golden(outputs, n_rows, seed=0):
+    for name, df in outputs.items():
+        path = _golden_path(n_rows, seed, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_csv(path, index=False)
+
+def compare_golden(outputs, n_rows, seed=0, rtol=1e-9):
+    # list of differences against the stored golden outputs; empty means unchanged
+    differences = []
+    for name, df in outputs.items():
+        path = _golden_path(n_rows, seed, name)
+        if not os.path.exists(path):
+            differences.append(f"{name}: no golden file at {path}")
+            continue
+        golden = pd.read_csv(path)
+        # round-trip through csv so both sides carry the same dtypes
+        current = pd.read_csv(io.StringIO(df.to_csv(index=False)))
+        try:
+            pd.testing.assert_frame_equal(current, golden, check_dtype=False, rtol=rtol)
+        except AssertionError as e:
+            differences.append(f"{name}: {e}")
+    return differences
+
+def bench_season_standardization(n_rows=1_000_000, seed=0):
+    raw = synthetic_seasons(n_rows, seed)
+
+    start = time.perf_counter()
+    per_row = raw.apply(standardize_season)
+    per_row_time = time.perf_counter() - start
+
+    _season_cache.clear()
+    start = time.perf_counter()
+    memo_cold = standardize_seasons(raw)
+    memo_cold_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    standardize_seasons(raw)
+    memo_warm_time = time.perf_counter() - start
+
+    assert per_row.equals(memo_cold), "memoized seasons differ from per-row apply"
+    return {
+        "rows": n_rows,
+        "per_row_apply_s": per_row_time,
+        "memo_cold_s": memo_cold_time,
+        "memo_warm_s": memo_warm_time,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the aging provision pipeline on synthetic SOH data")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(BENCH_SIZES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mapping", default="mapping.xlsx")
+    parser.add_argument("--combinations", default="combinations.xlsx")
+    parser.add_argument("--track-memory", action="store_true", help="tracemalloc peak per stage (slower)")
+    parser.add_argument("--paths", nargs="+", choices=BENCH_PATHS, default=list(BENCH_PATHS))
+    parser.add_argument("--update-golden", action="store_true", help="rewrite the goldens from the serial path")
+    parser.add_argument("--seasons", action="store_true", help="also run the season standardization benchmark")
+    args = parser.parse_args()
+
+    failed = False
+    for n_rows in args.rows:
+        for path in (["serial"] if args.update_golden else args.paths):
+            run = bench_pipeline(n_rows, args.mapping, args.combinations, args.seed, args.track_memory, path)
+            print(f"\n{n_rows:,} rows, {path}: pipeline {run['pipeline_s']:.2f}s, "
+                  f"with analysis and GL {run['total_s']:.2f}s")
+            print(run["stages"].to_string(index=False, float_format="{:,.3f}".format))
+            if args.update_golden:
+                write_golden(run["outputs"], n_rows, args.seed)
+                print("golden outputs written")
+                continue
+            differences = compare_golden(run["outputs"], n_rows, args.seed)
+            if differences:
+                failed = True
+                print("GOLDEN MISMATCH\n" + "\n".join(differences))
+            else:
+                print("golden outputs match")
+        if args.seasons:
+            print(bench_season_standardization(n_rows, args.seed))
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+import pandas as pd
+from my_io import read_workbook
+from my_funct import run_aging_provision_pipeline_chunked, get_analysis, get_GL_entry, check_parameters
+from my_parallel import run_aging_provision_pipeline_parallel, PARTITION_MODES
+from my_trace import PipelineTrace
+from my_history import save_run
+
+# Headless entry point for scheduled runs, as a command and as a function:
+#   python my_cli.py soh.csv.gz --balances balances.xlsx --output Output/cli
+#   from my_cli import run_provision; run_provision("soh.parquet", balances="balances.csv")
+# The SOH may be xlsx, CSV, gzip CSV or Parquet and is always streamed in chunks, so memory
+# follows --chunksize rather than the file size. Nothing here imports Streamlit, and the xlsx
+# engine is only loaded when one of the inputs is a workbook not yet in the parquet cache.
+# With --workers above 1 the SOH is instead read whole and provisioned in partitions over a
+# process pool (see my_parallel); the results are the same.
+
+CLI_OUTPUT_DIR = os.path.join("Output", "cli")
+BALANCE_COLUMNS = ['s1', 's2', 's3', 's4', 'Closing balance']
+
+def read_balances(source):
+    # existing closing balances per segment for the GL diff entry; none means an empty ledger
+    if source is None:
+        return pd.DataFrame({c: pd.Series(dtype=float) for c in BALANCE_COLUMNS})
+    return read_workbook(source, "balances", columns=BALANCE_COLUMNS)
+
+def run_provision(soh, mapping="mapping.xlsx", combinations="combinations.xlsx", balances=None,
+                  parameters=None, output_dir=CLI_OUTPUT_DIR, chunksize=200_000, rows_output=None,
+                  workers=1, partition_by="brand", history_label=None, trace=None):
+    # Provision, analysis checks and GL entries of one SOH file. Returns the pipeline results
+    # plus "analysis", "completed_entry" and "diff_entry"; with output_dir set they are also
+    # written there as CSV (diff_entry only when balances are given). rows_output, when set,
+    # receives the per-row output as CSV, written chunk by chunk. workers above 1 switches to the
+    # partitioned parallel run, split by partition_by ("brand" or "rows"). history_label, when
+    # set, also saves the run to the run history (my_history) and returns its id as "run_id".
+    parameters = check_parameters(parameters)
+    if workers is None or workers > 1:
+        if rows_output:
+            raise ValueError("The per-row output is only written by the serial run (workers=1)")
+        results = run_aging_provision_pipeline_parallel(
+            soh, mapping, combinations, **parameters, workers=workers, partition_by=partition_by, trace=trace)
+    else:
+        results = run_aging_provision_pipeline_chunked(
+            soh, mapping, combinations, **parameters, chunksize=chunksize, output_path=rows_output, trace=trace)
+    results["analysis"] = get_analysis(results["cube"], results["mapping"], trace, results["unmatched"])
+    completed_entry, diff_entry, _ = get_GL_entry(results["cube"], read_balances(balances), trace)
+    results["completed_entry"] = completed_entry
+    results["diff_entry"] = diff_entry
+    if trace is not None:
+        trace.stop()
+        results["trace"] = trace.to_frame()
+
+    if history_label is not None:
+        results["run_id"] = save_run(results, parameters, history_label, soh if isinstance(soh, str) else "", completed_entry=completed_entry,
+                                     diff_entry=diff_entry if balances is not None else None)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        results["summary"].to_csv(os.path.join(output_dir, "summary.csv"))
+        results["cube"].to_csv(os.path.join(output_dir, "cube.csv"), index=False)
+        completed_entry.to_csv(os.path.join(output_dir, "completed_entry.csv"), index=False)
+        if balances is not None:
+            diff_entry.to_csv(os.path.join(output_dir, "diff_entry.csv"), index=False)
+        results["unmatched"]["mapping"].to_csv(os.path.join(output_dir, "unmatched_mapping.csv"), index=False)
+        results["unmatched"]["combinations"].to_csv(os.path.join(output_dir, "unmatched_combinations.csv"), index=False)
+        if trace is not None:
+            trace.write(os.path.join(output_dir, "trace.jsonl"))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the aging provision and GL entries for one SOH file.")
+    parser.add_argument("soh", help="SOH as .xlsx, .csv, .csv.gz or .parquet")
+    parser.add_argument("--mapping", default="mapping.xlsx")
+    parser.add_argument("--combinations", default="combinations.xlsx")
+    parser.add_argument("--balances", help="existing closing balances (s1..s4, Closing balance) for the diff entry")
+    parser.add_argument("--params", help="JSON file with pipeline parameters")
+    parser.add_argument("--output", default=CLI_OUTPUT_DIR)
+    parser.add_argument("--chunksize", type=int, default=200_000)
+    parser.add_argument("--rows-output", help="also write the per-row output to this CSV (serial runs only)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for a partitioned parallel run; 1 streams the SOH serially, 0 uses every core")
+    parser.add_argument("--partition-by", choices=PARTITION_MODES, default="brand")
+    parser.add_argument("--trace", action="store_true", help="record stage timings to <output>/trace.jsonl")
+    parser.add_argument("--save-run", metavar="LABEL", help="also save the run to the run history under LABEL")
+    args = parser.parse_args()
+
+    parameters = {}
+    if args.params:
+        with open(args.params) as f:
+            parameters = json.load(f)
+    start = time.perf_counter()
+    results = run_provision(args.soh, args.mapping, args.combinations, args.balances, parameters,
+                            output_dir=args.output, chunksize=args.chunksize, rows_output=args.rows_output,
+                            workers=args.workers or None, partition_by=args.partition_by, history_label=args.save_run,
+                            trace=PipelineTrace() if args.trace else None)
+    summary = results["summary"]
+    print(f"{results['rows']:,} rows in {time.perf_counter() - start:.2f}s, written to {args.output}")
+    print(f"NETTOTAL_COST {summary['NETTOTAL_COST'].sum():,.2f}  Total Provision {summary['Total Provision'].sum():,.2f}")
+    print(f"missing Std Brand cost {results['analysis']['missing_in_std_brand']:,.2f}  "
+          f"missing combination cost {results['analysis']['missing_comb_rows']:,.2f}")
+    if "run_id" in results:
+        print(f"saved to the run history as {results['run_id']}")
@@ -2,230 +2,690 @@ import pandas as pd
 import numpy as np
 import os
 import re
+from my_io import read_workbook, iter_workbook_chunks
+from my_lookup import mapping_lookup, combinations_lookup, upper_categories, unmatched_keys, merge_unmatched
+from my_trace import NO_TRACE
+
+# SOH columns the provision logic actually reads; pass as soh_columns to prune the load
+SOH_COLUMNS = ['GROUP_NAME', 'AR Comments', 'NETTOTAL_COST', 'SEASON_DESC', 'SEASON DESC', 'LOCATION', 'LOCATION_NAME']
+
+# low-cardinality text columns held as categoricals once the frame is prepared
+CATEGORY_COLUMNS = ['GROUP_NAME', 'LOCATION_NAME', 'Std Brand', 'Model', 'Closed_status', 'AR Comments',
+                    'SEASON_DESC', 'SEASON DESC', 'std_season', 'season_bucket', 'location_catergory']
+SEGMENT_COLUMNS = ['s1', 's2', 's3', 's4', 's5']
+
+def compact_frame(df):
+    # categoricals for repeated text, smallest integer dtype for segment codes; costs stay
+    # float64 so provision totals are unchanged to the cent
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    for col in SEGMENT_COLUMNS:
+        if col in df.columns and pd.api.types.is_float_dtype(df[col]):
+            values = df[col].to_numpy()
+            if np.isfinite(values).all() and (values == np.round(values)).all():
+                df[col] = pd.to_numeric(values.astype(np.int64), downcast='integer')
+    return df
+
+def fill_missing_zero(df):
+    # DataFrame.fillna(0) that also works on categoricals; 0 is added as the first
+    # category so groupby keeps the order the object column sorted in
+    for col in df.columns[df.isna().any().to_numpy()]:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.set_categories([0] + list(df[col].cat.categories))
+        df[col] = df[col].fillna(0)
+    return df
+
+def memory_report(df):
+    usage = df.memory_usage(deep=True)
+    report = pd.DataFrame({
+        'dtype': df.dtypes.astype(str),
+        'bytes': usage.drop('Index'),
+    })
+    report.loc['Total'] = ['', usage.sum()]
+    report['MB'] = report['bytes'] / 2**20
+    return report
+
+def season_sort_key(season):
+    if not isinstance(season, str) or len(season) < 4:
+        return (0, 0)
+    season_type = season[:2]
+    year = int(season[-2:])
+    season_rank = 1 if season_type == "AW" else 0
+    return (year, season_rank)
+
+def standardize_season(raw_season):
+    if not isinstance(raw_season, str) or raw_season.strip() == "":
+        return "Unknown"
+    season = raw_season.strip().upper()
+    if "CONTINUITY" in season or "BASICS" in season:
+        return "Continuity"
+    elif "OLD" in season:
+        return "Old-"
+    year_match = re.search(r"(20\d{2})", season)
+    if year_match:
+        year = year_match.group(1)[2:]
+        if any(tag in season for tag in ["SPRING", "SUMMER", "SS"]):
+            return f"SS{year}"
+        elif any(tag in season for tag in ["AUTUMN", "WINTER", "AW"]):
+            return f"AW{year}"
+    match = re.search(r"(SS|AW)(\d{2})", season)
+    if match:
+        return f"{match.group(1)}{match.group(2)}"
+    if "WA" in season:
+        match = re.search(r"WA(\d{2})", season)
+        if match:
+            return f"AW{match.group(1)}"
+    match = re.search(r"(\d{2})", season)
+    if match:
+        return f"SS{match.group(1)}"
+    return "Unknown"
+
+# raw SEASON_DESC -> standard season, kept across runs; extracts only carry a
+# few hundred distinct descriptions, so each one is parsed once per process
+_season_cache = {}
+
+def standardize_seasons(raw_seasons: pd.Series) -> pd.Series:
+    codes, uniques = pd.factorize(raw_seasons)
+    for raw_season in uniques:
+        if raw_season not in _season_cache:
+            _season_cache[raw_season] = standardize_season(raw_season)
+    # code -1 marks NaN, which picks up the trailing "Unknown"
+    lookup = np.array([_season_cache[raw_season] for raw_season in uniques] + ["Unknown"], dtype=object)
+    return pd.Series(lookup[codes], index=raw_seasons.index)
+
+def filter_soh(soh, mapping, trace=None, unmatched=None):
+    # rows in scope, joined to the (upper-cased) mapping and carrying std_season;
+    # works on a whole SOH frame or on one streamed chunk of it. unmatched, when given, is a
+    # dict that receives the GROUP_NAME values missing from the mapping under "mapping".
+    trace = trace or NO_TRACE
+    with trace.stage("filter") as record:
+        soh = soh.loc[(soh['GROUP_NAME'] != 'Aleph') & (soh['AR Comments'] == 'Consider')].copy()
+        soh['NETTOTAL_COST'] = pd.to_numeric(soh['NETTOTAL_COST'].fillna(0), errors='coerce')
+        original_season = 'SEASON_DESC' if 'SEASON_DESC' in soh.columns else 'SEASON DESC'
+        soh['GROUP_NAME'] = upper_categories(soh['GROUP_NAME'])
+        record["rows"] = len(soh)
+    with trace.stage("mapping_merge") as record:
+        soh, missing = mapping_lookup(mapping).attach(soh, value='NETTOTAL_COST')
+        if unmatched is not None:
+            unmatched["mapping"] = missing
+        soh = soh.loc[soh['Closed_status'] != 'Exit'].copy()
+        record["rows"] = len(soh)
+    with trace.stage("season_standardization") as record:
+        soh['std_season'] = standardize_seasons(soh[original_season])
+        record["rows"] = len(soh)
+    return soh
+
+def prepare_aging_inputs(soh_path, mapping, combinations, soh_columns=None, use_cache=True, trace=None):
+    trace = trace or NO_TRACE
+    os.makedirs("Output", exist_ok=True)
 
-def run_aging_provision_pipeline(
-    soh_path,
-    mapping,
-    combinations,
+    with trace.stage("read") as record:
+        soh = read_workbook(soh_path, "soh", columns=soh_columns, use_cache=use_cache)
+        mapping = read_workbook(mapping, "mapping", use_cache=use_cache)
+        combinations = read_workbook(combinations, "combinations", use_cache=use_cache)
+        record["rows"] = len(soh)
+    #mapping = pd.read_excel('mapping.xlsx', sheet_name='Sheet1')
+    #combinations = combinations = pd.read_excel('combinations.xlsx', sheet_name='Sheet1').groupby(['LOCATION', 'Std Brand']).first().reset_index()
+
+    mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
+    unmatched = {}
+    soh = filter_soh(soh, mapping, trace, unmatched)
+    with trace.stage("compact_dtypes") as record:
+        soh = compact_frame(soh.reset_index(drop=True))
+        record["rows"] = len(soh)
+
+    # s1..s4 looked up once and kept row-aligned with soh, so re-provisioning only concatenates them
+    with trace.stage("combinations_merge") as record:
+        lookup = combinations_lookup(combinations)
+        if lookup.duplicated:
+            raise ValueError("Combinations have more than one row for a Std Brand and LOCATION")
+        _, positions = lookup.match(soh)
+        soh_combinations = lookup.frame(positions)
+        unmatched["combinations"] = unmatched_keys(soh[positions < 0], lookup.keys, 'NETTOTAL_COST')
+        record["rows"] = len(soh_combinations)
+
+    return {
+        "soh": soh,
+        "soh_combinations": soh_combinations,
+        "mapping": mapping,
+        "unmatched": unmatched,
+    }
+
+# std_season values without a date; season_buckets places them by name, not by age
+UNDATED_SEASONS = ('Unknown', 'Continuity', 'Old-', 'AW97')
+
+def season_ordinals(std_seasons):
+    # distinct std_season values -> integer age ordinal, 0 for the newest dated season;
+    # -1 for the undated ones
+    dated = [s for s in std_seasons if s not in UNDATED_SEASONS]
+    ordinal = {s: i for i, s in enumerate(sorted(dated, key=season_sort_key, reverse=True))}
+    return np.array([ordinal.get(s, -1) for s in std_seasons], dtype=np.int64)
+
+def undated_season_buckets(unknown_season_in_bucket1=True):
+    # undated std_season -> bucket code (0 = bucket1 ... 3 = bucket4)
+    if unknown_season_in_bucket1:
+        return {'Unknown': 0, 'Continuity': 0, 'Old-': 3, 'AW97': 3}
+    return {'Continuity': 0, 'Unknown': 3, 'Old-': 3, 'AW97': 3}
+
+def season_bucket_codes(std_seasons, ordinals, first_first_bucket_number_seasons=5, unknown_season_in_bucket1=True):
+    # bucket code of each distinct std_season from its ordinal: the first n dated seasons are
+    # bucket1, the next 3 bucket2, the next 3 bucket3 and the rest bucket4
+    n = first_first_bucket_number_seasons
+    codes = np.searchsorted(np.array([n, n + 3, n + 6]), ordinals, side='right')
+    undated = undated_season_buckets(unknown_season_in_bucket1)
+    for i in np.flatnonzero(ordinals < 0):
+        codes[i] = undated.get(std_seasons[i], 3)
+    return codes
+
+def season_buckets(std_seasons, first_first_bucket_number_seasons=5, unknown_season_in_bucket1=True):
+    # distinct std_season values -> (bucket1, bucket2, bucket3, bucket4) season lists
+    dated = sorted((s for s in std_seasons if s not in UNDATED_SEASONS), key=season_sort_key, reverse=True)
+    codes = season_bucket_codes(dated, np.arange(len(dated)), first_first_bucket_number_seasons)
+    buckets = tuple([s for s, code in zip(dated, codes) if code == bucket] for bucket in range(4))
+    for season, bucket in undated_season_buckets(unknown_season_in_bucket1).items():
+        buckets[bucket].append(season)
+    return buckets
+
+def season_bucket_lookup(buckets, std_seasons):
+    # bucket code of each distinct std_season given season_buckets lists (first list wins,
+    # bucket4 for anything not listed), plus a trailing bucket4 entry for missing seasons
+    bucket_of = {}
+    for bucket, seasons in reversed(list(enumerate(buckets[:3]))):
+        bucket_of.update(dict.fromkeys(seasons, bucket))
+    return np.array([bucket_of.get(s, 3) for s in std_seasons] + [3], dtype=np.int8)
+
+# LOCATION_NAME substring -> location category, first match wins
+LOCATION_PATTERNS = [('sulay', 'Leftover'), ('damage', 'Damage'), ('leftover', 'Leftover')]
+DEFAULT_LOCATION_CATEGORY = "Store, Online & WH"
+LOCATION_CATEGORIES = ['Damage', 'Leftover', DEFAULT_LOCATION_CATEGORY]
+
+CONTINUITY_FACTOR = 0.40
+BUCKET_POLICY_PERCENTAGE = {'bucket1': 0, 'bucket2': 0.15, 'bucket3': 0.50, 'bucket4': 0.75}
+BUCKET_NAMES = list(BUCKET_POLICY_PERCENTAGE)
+# policy % by bucket code
+BUCKET_POLICY_RATES = np.array(list(BUCKET_POLICY_PERCENTAGE.values()), dtype=float)
+
+# models outside the aging policy: no policy provision and no additional provision
+EXCLUDED_MODELS = ['Consignment', 'Guaranteed Margin', 'Buying Pull - Mango']
+
+# Additional provision rules, first match wins; a missing key matches anything and "closed"
+# tests Closed_status == "Closed". "rate" names the apply_provision_parameters argument that
+# holds the percentage, None means no additional provision. Brand-specific overrides are
+# checked before all of them.
+PROVISION_RULES = [
+    {"models": EXCLUDED_MODELS, "rate": None},
+    {"location": "Damage", "rate": "damage_percentage"},
+    {"location": "Leftover", "closed": True, "rate": "leftover_closed_percentage"},
+    {"location": "Leftover", "closed": False, "rate": "leftover_running_percentage"},
+    {"location": DEFAULT_LOCATION_CATEGORY, "closed": True, "rate": "closed_percentage"},
+]
+
+def location_category(location_name):
+    name = str(location_name).lower()
+    for pattern, category in LOCATION_PATTERNS:
+        if pattern in name:
+            return category
+    return DEFAULT_LOCATION_CATEGORY
+
+def classify_locations(location_names: pd.Series) -> pd.Categorical:
+    # each distinct LOCATION_NAME is classified once and broadcast back by code
+    codes, uniques = pd.factorize(location_names)
+    lookup = np.array([LOCATION_CATEGORIES.index(location_category(name)) for name in uniques]
+                      + [LOCATION_CATEGORIES.index(location_category(np.nan))], dtype=np.int8)
+    return pd.Categorical.from_codes(lookup[codes], categories=LOCATION_CATEGORIES)
+
+def _factorize_combinations(columns):
+    # one code per row for the combination of the given columns, plus the distinct combinations
+    combined = np.zeros(len(columns[0]), dtype=np.int64)
+    levels = []
+    for values in columns:
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        combined = combined * len(uniques) + codes
+        levels.append(np.asarray(uniques, dtype=object))
+    row_codes, combined_uniques = pd.factorize(combined)
+    combinations = []
+    for code in combined_uniques:
+        combination = []
+        for uniques in reversed(levels):
+            code, position = divmod(code, len(uniques))
+            combination.append(uniques[position])
+        combinations.append(tuple(reversed(combination)))
+    return row_codes, combinations
+
+def provision_rule(category, closed_status, model):
+    # rate parameter name of the first matching rule, None when no additional provision applies
+    for rule in PROVISION_RULES:
+        if "location" in rule and rule["location"] != category:
+            continue
+        if "closed" in rule and rule["closed"] != (closed_status == "Closed"):
+            continue
+        if "models" in rule and model not in rule["models"]:
+            continue
+        return rule["rate"]
+    return None
+
+def provision_rate(category, closed_status, model, brand, rates, brand_specific_provision):
+    # additional provision percentage for one key combination, NaN when none applies
+    if brand in brand_specific_provision:
+        return brand_specific_provision[brand]
+    rule = provision_rule(category, closed_status, model)
+    return np.nan if rule is None else rates[rule]
+
+def _season_codes(std_season):
+    # integer code per row and the distinct values, free for an already categorical column
+    if isinstance(std_season.dtype, pd.CategoricalDtype):
+        return std_season.cat.codes.to_numpy(), list(std_season.cat.categories)
+    codes, uniques = pd.factorize(std_season)
+    return codes, list(uniques)
+
+def compute_provision(soh, buckets, damage_percentage, leftover_running_percentage,
+                      leftover_closed_percentage, closed_percentage, brand_specific_provision, trace=None):
+    # adds season_bucket, location_catergory and the provision columns to soh in place
+    trace = trace or NO_TRACE
+    with trace.stage("bucketing") as record:
+        # one lookup per distinct season, then an integer take per row (code -1 = no season -> bucket4)
+        season_codes, std_seasons = _season_codes(soh['std_season'])
+        bucket_codes = season_bucket_lookup(buckets, std_seasons)[season_codes]
+        soh['season_bucket'] = pd.Categorical.from_codes(bucket_codes, categories=BUCKET_NAMES)
+        policy_percentage = BUCKET_POLICY_RATES[bucket_codes]
+        record["rows"] = len(soh)
+
+    with trace.stage("provisioning") as record:
+        location_categories = classify_locations(soh['LOCATION_NAME'])
+
+        # the rule table is evaluated once per distinct location category x closed status x model x brand
+        rates = {
+            "damage_percentage": damage_percentage,
+            "leftover_running_percentage": leftover_running_percentage,
+            "leftover_closed_percentage": leftover_closed_percentage,
+            "closed_percentage": closed_percentage,
+        }
+        row_codes, combinations = _factorize_combinations(
+            [location_categories, soh['Closed_status'], soh['Model'], soh['Std Brand']])
+        combination_rate = np.array([provision_rate(*combination, rates, brand_specific_provision)
+                                     for combination in combinations], dtype=float)
+        combination_excluded = np.array([combination[2] in EXCLUDED_MODELS for combination in combinations], dtype=bool)
+        rate = combination_rate[row_codes]
+        excluded = combination_excluded[row_codes]
+
+        cost = soh['NETTOTAL_COST'].to_numpy(dtype=float)
+        continuity_factor = np.where(excluded, 0.0, CONTINUITY_FACTOR)
+        policy_percentage = np.where(excluded, 0.0, policy_percentage)
+        provision_amount_policy = np.where(excluded, 0.0, cost * policy_percentage * continuity_factor)
+        soh['Continuity_factor'] = continuity_factor
+        soh['provision_%_policy'] = policy_percentage
+        soh['provision_amount_policy'] = provision_amount_policy
+        soh['location_catergory'] = location_categories
+        soh['additional_provision'] = np.where(np.isnan(rate), 0.0, cost * rate - provision_amount_policy)
+
+        soh['provision_amount_policy'] = soh['provision_amount_policy'].fillna(0)
+        soh['additional_provision'] = soh['additional_provision'].fillna(0)
+        soh['Total Provision'] = soh['provision_amount_policy'] + soh['additional_provision']
+        record["rows"] = len(soh)
+    return soh
+
+SUMMARY_COLUMNS = ["NETTOTAL_COST", 'provision_amount_policy', 'additional_provision', 'Total Provision']
+
+def brand_summary(summary):
+    # per-brand sums of SUMMARY_COLUMNS -> summary with coverage
+    summary['coverage'] = summary['Total Provision'] / summary['NETTOTAL_COST']
+    return summary
+
+# The aggregate cube holds the SUMMARY_COLUMNS sums and row counts per combination of these
+# keys (plus the original season column). It is a few thousand rows however large the SOH is,
+# and every summary, check and GL entry is a roll-up of it.
+CUBE_KEYS = ['Std Brand', 'location_catergory', 'Closed_status', 'season_bucket', 'std_season',
+             's1', 's2', 's3', 's4', 'Model']
+CUBE_ROW_COUNT = 'row_count'
+
+def season_column(df):
+    return 'SEASON_DESC' if 'SEASON_DESC' in df.columns else 'SEASON DESC'
+
+def build_aggregate_cube(soh_comb):
+    keys = CUBE_KEYS + [season_column(soh_comb)]
+    grouped = soh_comb.groupby(keys, observed=True, dropna=False, sort=False)
+    cube = grouped[SUMMARY_COLUMNS].sum()
+    cube[CUBE_ROW_COUNT] = grouped.size()
+    return _object_keys(cube.reset_index())
+
+def _object_keys(cube):
+    # the cube is small, so its keys go back to plain object columns: roll-ups then index and
+    # sort like the row-level frame did, and Streamlit can serialize the mixed 0/text categories
+    for col in cube.columns:
+        if isinstance(cube[col].dtype, pd.CategoricalDtype):
+            cube[col] = cube[col].astype(object)
+    return cube
+
+def merge_cubes(cubes):
+    # cubes of disjoint row sets (chunks, partitions) -> one cube
+    cube = pd.concat(cubes, ignore_index=True)
+    keys = CUBE_KEYS + [season_column(cube)]
+    cube = cube.groupby(keys, observed=True, dropna=False, sort=False)[SUMMARY_COLUMNS + [CUBE_ROW_COUNT]].sum()
+    return _object_keys(cube.reset_index())
+
+def as_cube(frame):
+    # the aggregate cube passes through, a row-level soh_comb is rolled up first
+    return frame if CUBE_ROW_COUNT in frame.columns else build_aggregate_cube(frame)
+
+# keyword arguments of apply_provision_parameters, as read from a parameter file
+PARAMETER_NAMES = [
+    'first_first_bucket_number_seasons', 'damage_percentage', 'leftover_running_percentage',
+    'leftover_closed_percentage', 'closed_percentage', 'brand_specific_provision',
+    'unknown_season_in_bucket1',
+]
+
+def check_parameters(parameters):
+    # a misspelt name would otherwise leave that parameter at its default without notice
+    unknown = sorted(set(parameters or {}) - set(PARAMETER_NAMES))
+    if unknown:
+        raise ValueError(f"Unknown provision parameters {unknown}; expected names from {PARAMETER_NAMES}")
+    return dict(parameters or {})
+
+def apply_provision_parameters(
+    prepared,
     first_first_bucket_number_seasons=5,
     damage_percentage=1.0,
     leftover_running_percentage=0.15,
     leftover_closed_percentage=0.5,
     closed_percentage=0.5,
     brand_specific_provision=None,
-    unknown_season_in_bucket1=True
+    unknown_season_in_bucket1=True,
+    trace=None
 ):
+    # trace: optional my_trace.PipelineTrace; its stage table is returned as results["trace"]
     brand_specific_provision = brand_specific_provision or {}
     pd.options.display.float_format = '{:,.2f}'.format
-    os.makedirs("Output", exist_ok=True)
-
-    def season_sort_key(season):
-        if not isinstance(season, str) or len(season) < 4:
-            return (0, 0)
-        season_type = season[:2]
-        year = int(season[-2:])
-        season_rank = 1 if season_type == "AW" else 0
-        return (year, season_rank)
-
-    def standardize_season(raw_season):
-        if not isinstance(raw_season, str) or raw_season.strip() == "":
-            return "Unknown"
-        season = raw_season.strip().upper()
-        if "CONTINUITY" in season or "BASICS" in season:
-            return "Continuity"
-        elif "OLD" in season:
-            return "Old-"
-        year_match = re.search(r"(20\d{2})", season)
-        if year_match:
-            year = year_match.group(1)[2:]
-            if any(tag in season for tag in ["SPRING", "SUMMER", "SS"]):
-                return f"SS{year}"
-            elif any(tag in season for tag in ["AUTUMN", "WINTER", "AW"]):
-                return f"AW{year}"
-        match = re.search(r"(SS|AW)(\d{2})", season)
-        if match:
-            return f"{match.group(1)}{match.group(2)}"
-        if "WA" in season:
-            match = re.search(r"WA(\d{2})", season)
-            if match:
-                return f"AW{match.group(1)}"
-        match = re.search(r"(\d{2})", season)
-        if match:
-            return f"SS{match.group(1)}"
-        return "Unknown"
-
-    soh = pd.read_excel(soh_path)
-    mapping = pd.read_excel(mapping)
-    combinations = pd.read_excel(combinations).groupby(['LOCATION', 'Std Brand']).first().reset_index()
-    soh = soh[(soh['GROUP_NAME'] != 'Aleph') & (soh['AR Comments'] == 'Consider')]
-    print("Current working directory:", os.getcwd())
-    print("Files in current directory:", os.listdir("."))
-    #mapping = pd.read_excel('mapping.xlsx', sheet_name='Sheet1')
-    #combinations = combinations = pd.read_excel('combinations.xlsx', sheet_name='Sheet1').groupby(['LOCATION', 'Std Brand']).first().reset_index()
+    # shallow copy: only new columns are written, the cached prepared frame stays untouched
+    soh = prepared["soh"].copy(deep=False)
 
-    soh['NETTOTAL_COST'].fillna(0, inplace=True)
-    soh['NETTOTAL_COST'] = pd.to_numeric(soh['NETTOTAL_COST'], errors='coerce')
-    original_season = 'SEASON_DESC' if 'SEASON_DESC' in soh.columns else 'SEASON DESC'
-    soh['GROUP_NAME'] = soh['GROUP_NAME'].str.upper()
-    mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
-    soh = soh.merge(mapping, on='GROUP_NAME', how='left')
-    soh = soh[(soh['Closed_status'] != 'Exit')]
-    soh['std_season'] = soh[original_season].apply(standardize_season)
-
-    excluded = {'Unknown', 'Continuity', 'Old-', 'AW97'}
-    unique_season = [f for f in soh['std_season'].dropna().unique() if f not in excluded]
-    sorted_std_season_in_soh = sorted(unique_season, key=season_sort_key, reverse=True)
-    if unknown_season_in_bucket1:
-        bucket1 = sorted_std_season_in_soh[:first_first_bucket_number_seasons] + ['Unknown', 'Continuity']
-        bucket2 = sorted_std_season_in_soh[first_first_bucket_number_seasons:first_first_bucket_number_seasons + 3]
-        bucket3 = sorted_std_season_in_soh[first_first_bucket_number_seasons + 3:first_first_bucket_number_seasons + 6]
-        bucket4 = sorted_std_season_in_soh[first_first_bucket_number_seasons + 6:] + ['Old-', 'AW97']
-    else:
-        bucket1 = sorted_std_season_in_soh[:first_first_bucket_number_seasons] + [ 'Continuity']
-        bucket2 = sorted_std_season_in_soh[first_first_bucket_number_seasons:first_first_bucket_number_seasons + 3]
-        bucket3 = sorted_std_season_in_soh[first_first_bucket_number_seasons + 3:first_first_bucket_number_seasons + 6]
-        bucket4 = sorted_std_season_in_soh[first_first_bucket_number_seasons + 6:] + ['Unknown','Old-', 'AW97']
-
-    conditions = [
-        soh['std_season'].isin(bucket1),
-        soh['std_season'].isin(bucket2),
-        soh['std_season'].isin(bucket3)
-    ]
-    soh['season_bucket'] = np.select(conditions, ['bucket1', 'bucket2', 'bucket3'], default='bucket4')
-    soh['Continuity_factor'] = 0.40
-    soh['provision_%_policy'] = soh['season_bucket'].map({'bucket1': 0, 'bucket2': 0.15, 'bucket3': 0.50, 'bucket4': 0.75})
-    soh.loc[soh['Model'].isin(['Consignment', 'Guaranteed Margin', 'Buying Pull - Mango']),
-            ['provision_amount_policy', 'provision_%_policy', 'Continuity_factor']] = 0
-    soh['provision_amount_policy'] = soh['NETTOTAL_COST'] * soh['provision_%_policy'] * soh['Continuity_factor']
-
-    soh['location_catergory'] = "Store, Online & WH"
-    soh.loc[soh['LOCATION_NAME'].astype(str).str.lower().str.contains('leftover', na=False), "location_catergory"] = "Leftover"
-    soh.loc[soh['LOCATION_NAME'].astype(str).str.lower().str.contains('damage', na=False), "location_catergory"] = "Damage"
-    soh.loc[soh['LOCATION_NAME'].astype(str).str.lower().str.contains('sulay', na=False), "location_catergory"] = "Leftover"
-
-    soh['additional_provision'] = 0
-    soh.loc[soh['location_catergory'] == "Damage", 'additional_provision'] = (
-        soh["NETTOTAL_COST"] * damage_percentage - soh['provision_amount_policy'])
-
-    condition = (soh['Closed_status'] == "Closed") & (soh['location_catergory'] == "Leftover")
-    soh.loc[condition, 'additional_provision'] = (
-        soh["NETTOTAL_COST"] * leftover_closed_percentage - soh['provision_amount_policy'])
-
-    condition = (soh['Closed_status'] != "Closed") & (soh['location_catergory'] == "Leftover")
-    soh.loc[condition, 'additional_provision'] = (
-        soh["NETTOTAL_COST"] * leftover_running_percentage - soh['provision_amount_policy'])
-
-    condition = (soh['Closed_status'] == "Closed") & (~soh['location_catergory'].isin(["Leftover", "Damage"]))
-    soh.loc[condition, 'additional_provision'] = (
-        soh["NETTOTAL_COST"] * closed_percentage - soh['provision_amount_policy'])
-
-    soh.loc[soh['Model'].isin(['Consignment', 'Guaranteed Margin', 'Buying Pull - Mango']),
-            ['provision_amount_policy', 'provision_%_policy', 'Continuity_factor', 'additional_provision']] = 0
-
-    if brand_specific_provision:
-        soh['additional_provision'] = np.where(
-            soh['Std Brand'].isin(brand_specific_provision.keys()),
-            soh['NETTOTAL_COST'] * soh['Std Brand'].map(brand_specific_provision) - soh['provision_amount_policy'],
-            soh['additional_provision']
-        )
-
-
-
-    soh['provision_amount_policy'] = soh['provision_amount_policy'].fillna(0)
-    soh['additional_provision'] = soh['additional_provision'].fillna(0)
-    soh['Total Provision'] = soh['provision_amount_policy'] + soh['additional_provision']
+    buckets = season_buckets(soh['std_season'].dropna().unique(), first_first_bucket_number_seasons,
+                             unknown_season_in_bucket1)
+    compute_provision(soh, buckets, damage_percentage, leftover_running_percentage,
+                      leftover_closed_percentage, closed_percentage, brand_specific_provision, trace)
     #soh.to_csv(os.path.join("Output", "aging_provision.csv"), index=False)
 
     # Generate analysis and checks
-    soh_comb = soh.merge(combinations, on=['Std Brand', 'LOCATION'], how='left').fillna(0)
+    with (trace or NO_TRACE).stage("combinations_attach") as record:
+        soh_comb = compact_frame(fill_missing_zero(pd.concat([soh, prepared["soh_combinations"]], axis=1)))
+        record["rows"] = len(soh_comb)
     #soh_comb.to_excel(os.path.join("Output", "aging_provision_combinations.xlsx"), index=False)
 
-    summary = soh_comb.groupby(by='Std Brand')[["NETTOTAL_COST", 'provision_amount_policy',
-                                                 'additional_provision', 'Total Provision']].sum()
-    summary['coverage'] = summary['Total Provision'] / summary['NETTOTAL_COST']
-
+    with (trace or NO_TRACE).stage("aggregation") as record:
+        cube = build_aggregate_cube(soh_comb)
+        summary = brand_summary(cube.groupby(by='Std Brand', observed=True)[SUMMARY_COLUMNS].sum())
+        record["rows"] = len(cube)
 
-
-    return {
+    results = {
 
         "summary": summary,
         "soh_comb": soh_comb,
+        "cube": cube,
+        "mapping": prepared["mapping"],
+        "unmatched": prepared["unmatched"],
+    }
+    if trace is not None:
+        results["trace"] = trace.to_frame()
+    return results
+
+def run_aging_provision_pipeline(
+    soh_path,
+    mapping,
+    combinations,
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.5,
+    closed_percentage=0.5,
+    brand_specific_provision=None,
+    unknown_season_in_bucket1=True,
+    trace=None
+):
+    prepared = prepare_aging_inputs(soh_path, mapping, combinations, trace=trace)
+    return apply_provision_parameters(
+        prepared,
+        first_first_bucket_number_seasons=first_first_bucket_number_seasons,
+        damage_percentage=damage_percentage,
+        leftover_running_percentage=leftover_running_percentage,
+        leftover_closed_percentage=leftover_closed_percentage,
+        closed_percentage=closed_percentage,
+        brand_specific_provision=brand_specific_provision,
+        unknown_season_in_bucket1=unknown_season_in_bucket1,
+        trace=trace
+    )
+
+def run_aging_provision_pipeline_chunked(
+    soh_path,
+    mapping,
+    combinations,
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.5,
+    closed_percentage=0.5,
+    brand_specific_provision=None,
+    unknown_season_in_bucket1=True,
+    chunksize=200_000,
+    output_path=None,
+    use_cache=True,
+    trace=None
+):
+    # Streams the SOH in two passes so memory is bounded by chunksize rather than file size:
+    # the first collects the distinct std_season values that fix the bucket boundaries, the
+    # second provisions each chunk and keeps only its aggregate cube. The merged cube feeds
+    # get_analysis and get_GL_entry in place of soh_comb; output_path, when set, receives the
+    # full per-row output as CSV, appended chunk by chunk.
+    brand_specific_provision = brand_specific_provision or {}
+    mapping = read_workbook(mapping, "mapping", use_cache=use_cache)
+    mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
+    combinations = read_workbook(combinations, "combinations", use_cache=use_cache)
+
+    std_seasons = set()
+    with (trace or NO_TRACE).stage("season_scan") as record:
+        for chunk in iter_workbook_chunks(soh_path, chunksize, columns=SOH_COLUMNS):
+            std_seasons.update(filter_soh(chunk, mapping)['std_season'].dropna().unique())
+        record["rows"] = len(std_seasons)
+    buckets = season_buckets(sorted(std_seasons), first_first_bucket_number_seasons, unknown_season_in_bucket1)
+
+    cubes = []
+    unmatched_mapping, unmatched_combinations = [], []
+    rows = 0
+    columns = None if output_path else SOH_COLUMNS
+    for chunk in iter_workbook_chunks(soh_path, chunksize, columns=columns):
+        unmatched = {}
+        soh = filter_soh(chunk, mapping, trace, unmatched)
+        unmatched_mapping.append(unmatched["mapping"])
+        compute_provision(soh, buckets, damage_percentage, leftover_running_percentage,
+                          leftover_closed_percentage, closed_percentage, brand_specific_provision, trace)
+        with (trace or NO_TRACE).stage("combinations_merge") as record:
+            soh_comb, missing = combinations_lookup(combinations).attach(soh, value='NETTOTAL_COST')
+            soh_comb = fill_missing_zero(soh_comb)
+            unmatched_combinations.append(missing)
+            record["rows"] = len(soh_comb)
+        with (trace or NO_TRACE).stage("aggregation") as record:
+            cubes.append(build_aggregate_cube(soh_comb))
+            record["rows"] = len(cubes[-1])
+        if output_path:
+            soh_comb.to_csv(output_path, mode='a' if rows else 'w', header=not rows, index=False)
+        rows += len(soh_comb)
+
+    if not cubes:
+        raise ValueError("SOH file has no rows in scope")
+    cube = merge_cubes(cubes)
+    summary = brand_summary(cube.groupby(by='Std Brand', observed=True)[SUMMARY_COLUMNS].sum())
+
+    results = {
+        "summary": summary,
+        "cube": cube,
         "mapping": mapping,
+        "rows": rows,
+        "unmatched": {
+            "mapping": merge_unmatched(unmatched_mapping, ['GROUP_NAME'], 'NETTOTAL_COST'),
+            "combinations": merge_unmatched(unmatched_combinations, ['Std Brand', 'LOCATION'], 'NETTOTAL_COST'),
+        },
+    }
+    if trace is not None:
+        results["trace"] = trace.to_frame()
+    return results
+
+def run_sensitivity(
+    cube,
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.5,
+    closed_percentage=0.5,
+    brand_specific_provision=None,
+    unknown_season_in_bucket1=True
+):
+    # Every grid argument takes a value or a list of values; all combinations are evaluated in
+    # one pass over the aggregate cube. With the bucket and rule of each cube row fixed, a
+    # row's total is cost x its rule percentage, or cost x policy % x continuity factor when
+    # no rule applies, so each scenario is a column of array math rather than a pipeline run.
+    # Returns the scenario parameters and a (scenario, Std Brand) result frame.
+    brand_specific_provision = brand_specific_provision or {}
+    grid = {
+        'first_first_bucket_number_seasons': first_first_bucket_number_seasons,
+        'damage_percentage': damage_percentage,
+        'leftover_running_percentage': leftover_running_percentage,
+        'leftover_closed_percentage': leftover_closed_percentage,
+        'closed_percentage': closed_percentage,
+    }
+    grid = {name: list(np.atleast_1d(values)) for name, values in grid.items()}
+    scenarios = pd.MultiIndex.from_product(list(grid.values()), names=list(grid.keys())).to_frame(index=False)
+    scenarios.index.name = 'scenario'
+
+    keys = ['Std Brand', 'location_catergory', 'Closed_status', 'Model', 'std_season']
+    base = as_cube(cube).groupby(keys, observed=True, dropna=False)['NETTOTAL_COST'].sum().reset_index()
+    cost = base['NETTOTAL_COST'].to_numpy(dtype=float)
+    combinations = list(zip(*(base[key] for key in keys)))
+    excluded = np.array([model in EXCLUDED_MODELS for _, _, _, model, _ in combinations], dtype=bool)
+
+    # rate of every base row in every scenario: brand override, or the rule's parameter
+    rate = np.full((len(base), len(scenarios)), np.nan)
+    for row, (brand, category, closed_status, model, _) in enumerate(combinations):
+        if brand in brand_specific_provision:
+            rate[row, :] = brand_specific_provision[brand]
+        else:
+            rule = provision_rule(category, closed_status, model)
+            if rule is not None:
+                rate[row, :] = scenarios[rule].to_numpy(dtype=float)
+
+    # policy % of every base row in every scenario: season ordinals once, then per distinct
+    # season count a searchsorted over the distinct seasons and a take over the base rows
+    season_codes, std_seasons = _season_codes(base['std_season'])
+    ordinals = season_ordinals(std_seasons)
+    policy_percentage = np.zeros((len(base), len(scenarios)))
+    for seasons in grid['first_first_bucket_number_seasons']:
+        codes = season_bucket_codes(std_seasons, ordinals, seasons, unknown_season_in_bucket1)
+        percentage = BUCKET_POLICY_RATES[np.append(codes, 3)[season_codes]]
+        columns = (scenarios['first_first_bucket_number_seasons'] == seasons).to_numpy()
+        policy_percentage[:, columns] = np.where(excluded, 0.0, percentage)[:, None]
+
+    provision_amount_policy = cost[:, None] * policy_percentage * CONTINUITY_FACTOR
+    total_provision = np.where(np.isnan(rate), provision_amount_policy, cost[:, None] * rate)
+
+    brand_codes, brands = pd.factorize(base['Std Brand'], sort=True)
+    def by_brand(values):
+        totals = np.zeros((len(brands), values.shape[1]))
+        np.add.at(totals, brand_codes, values)
+        return totals.T.ravel()
+
+    index = pd.MultiIndex.from_product([scenarios.index, brands], names=['scenario', 'Std Brand'])
+    results = pd.DataFrame({
+        'NETTOTAL_COST': by_brand(np.repeat(cost[:, None], len(scenarios), axis=1)),
+        'provision_amount_policy': by_brand(provision_amount_policy),
+        'Total Provision': by_brand(total_provision),
+    }, index=index)
+    results.insert(2, 'additional_provision', results['Total Provision'] - results['provision_amount_policy'])
+    results['coverage'] = results['Total Provision'] / results['NETTOTAL_COST']
+
+    return {
+        "scenarios": scenarios,
+        "results": results,
     }
 
 def get_GL_entry(soh_with_combinations: pd.DataFrame, 
-                 existing_balances: pd.DataFrame):
+                 existing_balances: pd.DataFrame, trace=None):
     
-    entry = soh_with_combinations.groupby(["s1","s2","s3","s4"])['Total Provision'].sum().reset_index().fillna(0)
-    entry['s5'] = 63002
-    entry['Total Provision'].sum()
-    entry2 = entry.copy()
-    entry2['Total Provision'] = entry2['Total Provision'] * -1
-    entry2['s5'] = 23993
-    completed_entry = pd.concat([entry, entry2], ignore_index=True)
-    completed_entry.rename(columns={'Total Provision': 'Dr/(CR)'}, inplace=True)
-    completed_entry = completed_entry[completed_entry['Dr/(CR)'] != 0]
-    completed_entry = completed_entry[['s1', 's2', 's3', 's4', 's5','Dr/(CR)']]
-    #completed_entry.to_csv(os.path.join("Output","completed_entry.csv"), index=False)
-
-    diff_table = soh_with_combinations.groupby(["s1","s2","s3","s4"])['Total Provision'].sum().reset_index().fillna(0).merge(existing_balances, on=['s1','s2','s3','s4'], how='outer').fillna(0)
-    diff_table['Dr/(CR)'] = (diff_table['Total Provision'] + diff_table['Closing balance'])*-1
-    diff_table.drop(['Closing balance','Total Provision'], inplace=True,axis=1)
-    diff_table['s5'] = 23993
-    diff_table2 = diff_table.copy()
-    diff_table2['Dr/(CR)'] = diff_table2['Dr/(CR)'] * -1
-    diff_table2['s5'] = 63002
-    diff_entry = pd.concat([diff_table, diff_table2], ignore_index=True)
-    #diff_entry.rename(columns={'Total Provision': 'Dr/(CR)'}, inplace=True)
-    diff_entry = diff_entry[diff_entry['Dr/(CR)'] != 0]
-    diff_entry = diff_entry[['s1', 's2', 's3', 's4', 's5','Dr/(CR)']]
-    #diff_entry.to_csv(os.path.join("Output","diff_entry.csv"), index=False)
+    trace = trace or NO_TRACE
+    with trace.stage("gl_entry") as record:
+        # soh_with_combinations may be the row-level soh_comb or its aggregate cube
+        segment_totals = as_cube(soh_with_combinations).groupby(["s1","s2","s3","s4"])['Total Provision'].sum().reset_index().fillna(0)
+        entry = segment_totals.copy()
+        entry['s5'] = 63002
+        entry['Total Provision'].sum()
+        entry2 = entry.copy()
+        entry2['Total Provision'] = entry2['Total Provision'] * -1
+        entry2['s5'] = 23993
+        completed_entry = pd.concat([entry, entry2], ignore_index=True)
+        completed_entry.rename(columns={'Total Provision': 'Dr/(CR)'}, inplace=True)
+        completed_entry = completed_entry[completed_entry['Dr/(CR)'] != 0]
+        completed_entry = completed_entry[['s1', 's2', 's3', 's4', 's5','Dr/(CR)']]
+        #completed_entry.to_csv(os.path.join("Output","completed_entry.csv"), index=False)
+
+        diff_table = segment_totals.merge(existing_balances, on=['s1','s2','s3','s4'], how='outer').fillna(0)
+        diff_table['Dr/(CR)'] = (diff_table['Total Provision'] + diff_table['Closing balance'])*-1
+        diff_table.drop(['Closing balance','Total Provision'], inplace=True,axis=1)
+        diff_table['s5'] = 23993
+        diff_table2 = diff_table.copy()
+        diff_table2['Dr/(CR)'] = diff_table2['Dr/(CR)'] * -1
+        diff_table2['s5'] = 63002
+        diff_entry = pd.concat([diff_table, diff_table2], ignore_index=True)
+        #diff_entry.rename(columns={'Total Provision': 'Dr/(CR)'}, inplace=True)
+        diff_entry = diff_entry[diff_entry['Dr/(CR)'] != 0]
+        diff_entry = diff_entry[['s1', 's2', 's3', 's4', 's5','Dr/(CR)']]
+        #diff_entry.to_csv(os.path.join("Output","diff_entry.csv"), index=False)
+        record["rows"] = len(segment_totals)
 
     return completed_entry, diff_entry, existing_balances
 
-def get_analysis(soh_with_combinations: pd.DataFrame,mapping: pd.DataFrame):
-    #mapping = pd.read_excel(mapping)
-    original_season = 'SEASON_DESC' if 'SEASON_DESC' in soh_with_combinations.columns else 'SEASON DESC'
-    #mapping = pd.read_excel("mapping.xlsx", sheet_name='Sheet1')
+def get_analysis(soh_with_combinations: pd.DataFrame,mapping: pd.DataFrame, trace=None, unmatched=None):
+    # unmatched: the pipeline results' "unmatched" lookup report, passed through as the
+    # unmatched_group_names / unmatched_combinations tables
+    trace = trace or NO_TRACE
+    with trace.stage("analysis") as record:
+        # every check below is a roll-up of the aggregate cube, built here if soh_comb is passed
+        soh_with_combinations = as_cube(soh_with_combinations)
+        #mapping = pd.read_excel(mapping)
+        original_season = 'SEASON_DESC' if 'SEASON_DESC' in soh_with_combinations.columns else 'SEASON DESC'
+        #mapping = pd.read_excel("mapping.xlsx", sheet_name='Sheet1')
     
-    damage_summary = soh_with_combinations[soh_with_combinations['location_catergory'] == 'Damage'].groupby('Std Brand')[['NETTOTAL_COST', 'Total Provision']].sum()
-    damage_summary['coverage'] = damage_summary['Total Provision'] / damage_summary['NETTOTAL_COST']
-    damage_summary
-
-    leftover_summary = soh_with_combinations[soh_with_combinations['location_catergory'] == 'Leftover'].groupby('Std Brand')[['NETTOTAL_COST', 'Total Provision']].sum()
-    leftover_summary['coverage'] = leftover_summary['Total Provision'] / leftover_summary['NETTOTAL_COST']
-    leftover_summary
-
-    closed_summary = soh_with_combinations[soh_with_combinations['Closed_status'] == 'Closed'].groupby('Std Brand')[['NETTOTAL_COST', 'Total Provision']].sum()
-    closed_summary['coverage'] = closed_summary['Total Provision'] / closed_summary['NETTOTAL_COST']
-    closed_summary
-
-    check_buckets = soh_with_combinations[['season_bucket','std_season' ]].drop_duplicates().sort_values(by='season_bucket', ascending=True)
-    check_season = soh_with_combinations[['std_season', original_season]].drop_duplicates().sort_values(by='std_season', ascending=True)
-
-    #missing combinations in output
-    missing_combinations = soh_with_combinations[(soh_with_combinations['NETTOTAL_COST'] != 0)&(soh_with_combinations['s1'].isna())] 
-    # Check for missing values in key columns
-    missing_in_std_brand = soh_with_combinations[soh_with_combinations['Std Brand'].isnull()]['NETTOTAL_COST'].sum()
-    #print("Net cost of missing std_brand :", missing_in_std_brand['NETTOTAL_COST'].sum())
-    # Check for duplicates in mapping [original brand name]
-    duplicates_mapping = mapping[mapping.duplicated(subset=['GROUP_NAME'], keep=False)].shape[0]
-    #print("Duplicate original brand names in mapping:", mapping[duplicates_mapping].shape[0])
-    missing_std_brands_in_soh = set(mapping['Std Brand']) - set(soh_with_combinations['Std Brand'])
-    #print("Std Brands in mapping missing in SOH:", missing_std_brands_in_soh)
-    # Check for garbage/unknown seasons in std_season
-    no_seasons = soh_with_combinations[(soh_with_combinations['std_season'] == "Unknown")&(~soh_with_combinations['Model'].isin([
-            'Consignment',
-            'Guaranteed Margin',
-            'Buying Pull - Mango'
-        ]))].groupby('Std Brand')[['NETTOTAL_COST', 'Total Provision']].sum()
-    no_seasons['coverage'] = no_seasons['Total Provision'] / no_seasons['NETTOTAL_COST']
-    #print("Cost of unknown std_season:", f"{garbage_seasons['NETTOTAL_COST'].sum():,.2f}")
-    # Check for missing in combinations merge
-    missing_comb_rows = soh_with_combinations[soh_with_combinations['s4'] == 0]['NETTOTAL_COST'].sum()
-    #print("Cost with combination mapping:", f"{missing_comb_rows['NETTOTAL_COST'].sum():,.2f}")
-
-    missing_seasons_details = soh_with_combinations[soh_with_combinations[original_season].isna() | (soh_with_combinations[original_season] == '')].groupby('Std Brand')['NETTOTAL_COST'].sum()
+        damage_summary = soh_with_combinations[soh_with_combinations['location_catergory'] == 'Damage'].groupby('Std Brand', observed=True)[['NETTOTAL_COST', 'Total Provision']].sum()
+        damage_summary['coverage'] = damage_summary['Total Provision'] / damage_summary['NETTOTAL_COST']
+        damage_summary
+
+        leftover_summary = soh_with_combinations[soh_with_combinations['location_catergory'] == 'Leftover'].groupby('Std Brand', observed=True)[['NETTOTAL_COST', 'Total Provision']].sum()
+        leftover_summary['coverage'] = leftover_summary['Total Provision'] / leftover_summary['NETTOTAL_COST']
+        leftover_summary
+
+        closed_summary = soh_with_combinations[soh_with_combinations['Closed_status'] == 'Closed'].groupby('Std Brand', observed=True)[['NETTOTAL_COST', 'Total Provision']].sum()
+        closed_summary['coverage'] = closed_summary['Total Provision'] / closed_summary['NETTOTAL_COST']
+        closed_summary
+
+        check_buckets = soh_with_combinations[['season_bucket','std_season' ]].drop_duplicates().sort_values(by='season_bucket', ascending=True)
+        check_season = soh_with_combinations[['std_season', original_season]].drop_duplicates().sort_values(by='std_season', ascending=True)
+
+        #missing combinations in output
+        missing_combinations = soh_with_combinations[(soh_with_combinations['NETTOTAL_COST'] != 0)&(soh_with_combinations['s1'].isna())] 
+        # Check for missing values in key columns
+        missing_in_std_brand = soh_with_combinations[soh_with_combinations['Std Brand'].isnull()]['NETTOTAL_COST'].sum()
+        #print("Net cost of missing std_brand :", missing_in_std_brand['NETTOTAL_COST'].sum())
+        # Check for duplicates in mapping [original brand name]
+        duplicates_mapping = mapping[mapping.duplicated(subset=['GROUP_NAME'], keep=False)].shape[0]
+        #print("Duplicate original brand names in mapping:", mapping[duplicates_mapping].shape[0])
+        missing_std_brands_in_soh = set(mapping['Std Brand']) - set(soh_with_combinations['Std Brand'])
+        #print("Std Brands in mapping missing in SOH:", missing_std_brands_in_soh)
+        # Check for garbage/unknown seasons in std_season
+        no_seasons = soh_with_combinations[(soh_with_combinations['std_season'] == "Unknown")&(~soh_with_combinations['Model'].isin(EXCLUDED_MODELS))].groupby('Std Brand', observed=True)[['NETTOTAL_COST', 'Total Provision']].sum()
+        no_seasons['coverage'] = no_seasons['Total Provision'] / no_seasons['NETTOTAL_COST']
+        #print("Cost of unknown std_season:", f"{garbage_seasons['NETTOTAL_COST'].sum():,.2f}")
+        # Check for missing in combinations merge
+        missing_comb_rows = soh_with_combinations[soh_with_combinations['s4'] == 0]['NETTOTAL_COST'].sum()
+        #print("Cost with combination mapping:", f"{missing_comb_rows['NETTOTAL_COST'].sum():,.2f}")
+
+        missing_seasons_details = soh_with_combinations[soh_with_combinations[original_season].isna() | (soh_with_combinations[original_season] == '')].groupby('Std Brand', observed=True)['NETTOTAL_COST'].sum()
+        record["rows"] = len(soh_with_combinations)
     return {
     "damage_summary": damage_summary,
     "leftover_summary": leftover_summary,
@@ -237,6 +697,8 @@ def get_analysis(soh_with_combinations: pd.DataFrame,mapping: pd.DataFrame):
     "missing_in_std_brand": missing_in_std_brand,
     "duplicates_mapping": duplicates_mapping,
     "missing_std_brands_in_soh": missing_std_brands_in_soh,
-    "missing_comb_rows": missing_comb_rows
+    "missing_comb_rows": missing_comb_rows,
+    "unmatched_group_names": unmatched["mapping"] if unmatched else None,
+    "unmatched_combinations": unmatched["combinations"] if unmatched else None
 
 }
@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import uuid
+from contextlib import closing
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from my_funct import CUBE_KEYS, CUBE_ROW_COUNT, SUMMARY_COLUMNS, SEGMENT_COLUMNS, brand_summary, season_column, get_GL_entry
+
+# Saved provision runs, kept in one SQLite file so past months can be reviewed and compared
+# without recomputing them. Each run stores its parameters, the per-brand summary, the
+# aggregate cube and its GL entries; every table is indexed by run, and comparisons are
+# grouped inside SQLite so only the two runs' totals are read back.
+
+HISTORY_PATH = os.path.join("Output", "history", "runs.sqlite")
+# the cube's original season column is stored under one name whichever the SOH used
+SEASON_COLUMN = 'SEASON_DESC'
+CUBE_COLUMNS = CUBE_KEYS + [SEASON_COLUMN] + SUMMARY_COLUMNS + [CUBE_ROW_COUNT]
+GL_COLUMNS = SEGMENT_COLUMNS + ['Dr/(CR)']
+COMPARE_KEYS = {
+    "brand": ['Std Brand'],
+    "bucket": ['season_bucket'],
+    "segment": ['s1', 's2', 's3', 's4'],
+}
+COMPARE_VALUES = ['NETTOTAL_COST', 'Total Provision']
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def _columns(columns):
+    return ", ".join(_quote(c) for c in columns)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, label TEXT, created TEXT, source TEXT, run_key TEXT,
+    parameters TEXT, rows INTEGER, total_cost REAL, total_provision REAL
+);
+CREATE TABLE IF NOT EXISTS summary (run_id TEXT, {_columns(['Std Brand'] + SUMMARY_COLUMNS)});
+CREATE TABLE IF NOT EXISTS cube (run_id TEXT, {_columns(CUBE_COLUMNS)});
+CREATE TABLE IF NOT EXISTS gl_entries (run_id TEXT, entry TEXT, {_columns(GL_COLUMNS)});
+CREATE INDEX IF NOT EXISTS summary_run ON summary (run_id, "Std Brand");
+CREATE INDEX IF NOT EXISTS cube_run_brand ON cube (run_id, "Std Brand");
+CREATE INDEX IF NOT EXISTS cube_run_bucket ON cube (run_id, season_bucket);
+CREATE INDEX IF NOT EXISTS cube_run_segment ON cube (run_id, s1, s2, s3, s4);
+CREATE INDEX IF NOT EXISTS gl_entries_run ON gl_entries (run_id, entry);
+"""
+
+def connect(path=HISTORY_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path)
+    # WAL lets the dashboard sessions read while a run is being saved
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def _sql_value(value, integral=False):
+    # numpy scalars and NaN -> what sqlite3 binds; segment codes read back as 101.0 or 101
+    # depending on the pipeline path are stored as the same integer
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if integral and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def _rows(run_id, df, columns, prefix=()):
+    integral = [c in SEGMENT_COLUMNS for c in columns]
+    for row in df[columns].itertuples(index=False, name=None):
+        yield (run_id, *prefix, *(_sql_value(v, i) for v, i in zip(row, integral)))
+
+def _insert(connection, table, run_id, df, columns, prefix_columns=(), prefix=()):
+    names = ['run_id', *prefix_columns, *columns]
+    connection.executemany(
+        f"INSERT INTO {table} ({_columns(names)}) VALUES ({', '.join('?' * len(names))})",
+        _rows(run_id, df, columns, prefix))
+
+def save_run(results, parameters, label="", source="", run_key=None, completed_entry=None, diff_entry=None,
+             path=HISTORY_PATH):
+    # results of any pipeline entry point (summary and cube are read from it); the completed
+    # GL entry is derived from the cube when not given, the diff entry only stored when given.
+    # Returns the new run id.
+    run_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+    summary = results["summary"]
+    cube = results["cube"].rename(columns={season_column(results["cube"]): SEASON_COLUMN})
+    if completed_entry is None:
+        completed_entry = get_GL_entry(cube, pd.DataFrame(columns=['s1', 's2', 's3', 's4', 'Closing balance']))[0]
+
+    with closing(connect(path)) as connection, connection:
+        connection.execute(
+            "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_id, label, datetime.now(timezone.utc).isoformat(), str(source), run_key,
+             json.dumps(parameters, default=str, sort_keys=True),
+             int(results.get("rows", cube[CUBE_ROW_COUNT].sum())),
+             float(summary['NETTOTAL_COST'].sum()), float(summary['Total Provision'].sum())))
+        _insert(connection, "summary", run_id, summary.reset_index(), ['Std Brand'] + SUMMARY_COLUMNS)
+        _insert(connection, "cube", run_id, cube, CUBE_COLUMNS)
+        _write_gl_entries(connection, run_id, completed_entry, diff_entry)
+    return run_id
+
+def _write_gl_entries(connection, run_id, completed_entry, diff_entry):
+    for entry, df in (("completed", completed_entry), ("diff", diff_entry)):
+        if df is not None:
+            connection.execute("DELETE FROM gl_entries WHERE run_id = ? AND entry = ?", (run_id, entry))
+            _insert(connection, "gl_entries", run_id, df, GL_COLUMNS, ('entry',), (entry,))
+
+def save_gl_entries(run_id, completed_entry=None, diff_entry=None, path=HISTORY_PATH):
+    # replaces the stored GL entries of a saved run, e.g. once the balances are available
+    with closing(connect(path)) as connection, connection:
+        if connection.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone() is None:
+            raise KeyError(f"No saved run {run_id!r}")
+        _write_gl_entries(connection, run_id, completed_entry, diff_entry)
+
+def list_runs(path=HISTORY_PATH):
+    with closing(connect(path)) as connection:
+        runs = pd.read_sql_query("SELECT * FROM runs ORDER BY created DESC", connection)
+    return runs.set_index('run_id')
+
+def delete_run(run_id, path=HISTORY_PATH):
+    with closing(connect(path)) as connection, connection:
+        for table in ("summary", "cube", "gl_entries", "runs"):
+            connection.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+
+def load_run(run_id, path=HISTORY_PATH):
+    # the stored run as the pipeline returned it: parameters, summary, cube and GL entries
+    with closing(connect(path)) as connection:
+        run = connection.execute("SELECT label, created, parameters FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if run is None:
+            raise KeyError(f"No saved run {run_id!r}")
+        read = lambda query, *args: pd.read_sql_query(query, connection, params=(run_id, *args))
+        summary = read(f"SELECT {_columns(['Std Brand'] + SUMMARY_COLUMNS)} FROM summary WHERE run_id = ?")
+        cube = read(f"SELECT {_columns(CUBE_COLUMNS)} FROM cube WHERE run_id = ?")
+        entries = {entry: read(f"SELECT {_columns(GL_COLUMNS)} FROM gl_entries WHERE run_id = ? AND entry = ?", entry)
+                   for entry in ("completed", "diff")}
+    return {
+        "label": run[0],
+        "created": run[1],
+        "parameters": json.loads(run[2]),
+        "summary": brand_summary(summary.set_index('Std Brand')),
+        "cube": cube,
+        "completed_entry": entries["completed"],
+        "diff_entry": entries["diff"] if len(entries["diff"]) else None,
+    }
+
+def compare_runs(run_a, run_b, by="brand", path=HISTORY_PATH):
+    # NETTOTAL_COST and Total Provision of two saved runs side by side, grouped by "brand",
+    # "bucket", "segment" or a list of cube key columns, with the change from run_a to run_b.
+    # Columns are "<value> A", "<value> B" and "Total Provision change".
+    keys = COMPARE_KEYS.get(by, by) if isinstance(by, str) else list(by)
+    unknown = [k for k in keys if k not in CUBE_KEYS + [SEASON_COLUMN]]
+    if unknown:
+        raise ValueError(f"Cannot compare runs by {unknown}; use {sorted(COMPARE_KEYS)} or cube key columns")
+    query = (f"SELECT run_id, {_columns(keys)}, "
+             + ", ".join(f"SUM({_quote(c)}) AS {_quote(c)}" for c in COMPARE_VALUES)
+             + f" FROM cube WHERE run_id IN (?, ?) GROUP BY run_id, {_columns(keys)}")
+    with closing(connect(path)) as connection:
+        totals = pd.read_sql_query(query, connection, params=(run_a, run_b))
+
+    sides = []
+    for run_id, side in ((run_a, "A"), (run_b, "B")):
+        frame = totals[totals['run_id'] == run_id].drop(columns='run_id')
+        frame = frame.groupby(keys, dropna=False)[COMPARE_VALUES].sum()
+        sides.append(frame.rename(columns=lambda c: f"{c} {side}"))
+    compared = sides[0].join(sides[1], how='outer').fillna(0)
+    compared = compared[[f"{c} {side}" for c in COMPARE_VALUES for side in "AB"]]
+    compared['Total Provision change'] = compared['Total Provision B'] - compared['Total Provision A']
+    return compared.sort_values('Total Provision change', key=np.abs, ascending=False)
@@ -0,0 +1,266 @@
+import json
+import os
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from my_funct import (SUMMARY_COLUMNS, CUBE_ROW_COUNT, season_column, season_buckets, filter_soh,
+                      compute_provision, fill_missing_zero, compact_frame, build_aggregate_cube, merge_cubes,
+                      brand_summary, prepare_aging_inputs, apply_provision_parameters)
+from my_io import file_digest, frame_digest, read_workbook, read_frame, write_frame, run_digest
+from my_lookup import mapping_lookup, combinations_lookup, unmatched_keys
+from my_trace import NO_TRACE
+
+# Month-over-month runs: the previous run's per-row provision is kept in a state directory and
+# only SOH rows that are new or changed since then are provisioned again. The aggregate cube is
+# updated by taking out the old rows' contribution and adding the new rows'.
+#
+# Rows are identified by LOCATION, ITEM and season (plus an occurrence number for repeated
+# keys) and compared by a hash of the whole row. The stored state is only reused when the
+# mapping, combinations and parameters are unchanged and the season buckets come out the same;
+# otherwise the run falls back to a full recompute and replaces the state.
+#
+# The state keeps rows as they were before fill_missing_zero: the 0 it leaves among text values
+# is stored as missing again, so the frames stay Parquet (Arrow cannot type text mixed with
+# numbers) and the lookup reports can be rebuilt from the stored rows. Runs fill them on reading.
+
+INCREMENTAL_DIR = os.path.join("Output", "incremental")
+STATE_VERSION = "v2"
+ROW_KEY = ['LOCATION', 'ITEM']
+OCCURRENCE = '_occurrence'
+ROW_HASH = '_row_hash'
+
+def _input_digest(source):
+    return frame_digest(source) if isinstance(source, pd.DataFrame) else file_digest(source)
+
+def _state_paths(state_dir):
+    return {
+        "meta": os.path.join(state_dir, "meta.json"),
+        "rows": os.path.join(state_dir, "rows.parquet"),
+        "provision": os.path.join(state_dir, "provision.parquet"),
+        "cube": os.path.join(state_dir, "cube.parquet"),
+    }
+
+def keyed_soh(soh):
+    # adds the occurrence number and the row hash used to diff against the previous run
+    keys = ROW_KEY + [season_column(soh)]
+    missing = [c for c in keys if c not in soh.columns]
+    if missing:
+        raise ValueError(f"Incremental mode needs SOH columns {keys}; missing {missing}")
+    soh = soh.reset_index(drop=True)
+    soh[OCCURRENCE] = soh.groupby(keys, dropna=False, sort=False).cumcount()
+    soh[ROW_HASH] = pd.util.hash_pandas_object(soh, index=False).to_numpy()
+    return soh
+
+def _without_fill(df):
+    # undoes fill_missing_zero on text columns (categorical in the rows, object in the cube):
+    # a 0 among text values becomes missing again
+    df = df.copy(deep=False)
+    for col in df.columns:
+        values = df[col]
+        categorical = isinstance(values.dtype, pd.CategoricalDtype)
+        if not categorical and values.dtype != object:
+            continue
+        if not pd.api.types.infer_dtype(values.cat.categories if categorical else values, skipna=True).startswith("mixed"):
+            continue
+        if categorical:
+            if 0 in values.cat.categories:
+                df[col] = values.cat.remove_categories([0])
+        else:
+            df[col] = values.mask(values.eq(0))
+    return df
+
+def load_state(state_dir):
+    # the stored frames as save_state wrote them, i.e. before the zero fill
+    paths = _state_paths(state_dir)
+    if not os.path.exists(paths["meta"]):
+        return None
+    with open(paths["meta"]) as f:
+        meta = json.load(f)
+    if meta.get("version") != STATE_VERSION:
+        return None
+    frames = {name: read_frame(paths[name]) for name in ("rows", "provision", "cube")}
+    if any(df is None for df in frames.values()):
+        return None
+    return {"meta": meta, **frames}
+
+def save_state(state_dir, meta, row_hashes, provision, cube):
+    paths = _state_paths(state_dir)
+    write_frame(pd.DataFrame({ROW_HASH: row_hashes}), paths["rows"])
+    write_frame(_without_fill(provision), paths["provision"])
+    write_frame(_without_fill(cube), paths["cube"])
+    # meta last: a run interrupted while writing leaves no meta and the next run starts over
+    with open(paths["meta"] + ".part", "w") as f:
+        json.dump({"version": STATE_VERSION, **meta}, f, indent=2)
+    os.replace(paths["meta"] + ".part", paths["meta"])
+
+def _bucket_sets(buckets):
+    return [sorted(set(map(str, bucket))) for bucket in buckets]
+
+def _buckets_for(std_seasons, parameters):
+    return season_buckets(sorted(set(std_seasons)), parameters['first_first_bucket_number_seasons'],
+                          parameters['unknown_season_in_bucket1'])
+
+def _negated(cube):
+    cube = cube.copy()
+    cube[SUMMARY_COLUMNS + [CUBE_ROW_COUNT]] *= -1
+    return cube
+
+def _concat_aligned(kept, new_rows):
+    # the new rows' values are appended to the stored categories, so the concat stays
+    # categorical (existing codes unchanged) instead of falling back to object columns
+    for col in kept.columns:
+        if isinstance(kept[col].dtype, pd.CategoricalDtype) and col in new_rows.columns:
+            values = pd.Index(new_rows[col].dropna().unique())
+            kept[col] = kept[col].cat.add_categories(values.difference(kept[col].cat.categories, sort=False))
+            new_rows[col] = pd.Categorical(new_rows[col], categories=kept[col].cat.categories)
+    return pd.concat([kept, new_rows], ignore_index=True)
+
+def _unmatched(rows, mapping, combinations):
+    # the lookup reports prepare_aging_inputs gives for these rows (provisioned, not yet zero filled);
+    # a key repeated in the table repeats the frame row in the match, an unmatched row never is
+    reports = {}
+    for name, lookup in (("mapping", mapping_lookup(mapping)), ("combinations", combinations_lookup(combinations))):
+        expanded, positions = lookup.match(rows)
+        missing = np.flatnonzero(positions < 0)
+        if expanded is not None:
+            missing = expanded[missing]
+        reports[name] = unmatched_keys(rows.iloc[missing], lookup.keys, 'NETTOTAL_COST')
+    return reports
+
+def _segment_totals(cube):
+    return cube.groupby(['s1', 's2', 's3', 's4'])['Total Provision'].sum()
+
+def run_incremental_provision(
+    soh_path,
+    mapping,
+    combinations,
+    state_dir=os.path.join(INCREMENTAL_DIR, "default"),
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.50,
+    closed_percentage=0.50,
+    brand_specific_provision=None,
+    unknown_season_in_bucket1=True,
+    use_cache=True,
+    trace=None
+):
+    # Same results as run_aging_provision_pipeline, plus:
+    #   mode           "incremental", or "full" when the stored state could not be reused
+    #   changed_rows   SOH rows provisioned in this run
+    #   removed_rows   rows of the previous run that are gone or were replaced
+    #   segment_delta  Total Provision movement per s1..s4 since the previous run, i.e. the
+    #                  GL diff entry once the previous run's entry has been booked
+    # "unmatched" covers every row of this SOH, the reused ones included.
+    trace = trace or NO_TRACE
+    parameters = dict(
+        first_first_bucket_number_seasons=first_first_bucket_number_seasons,
+        damage_percentage=damage_percentage,
+        leftover_running_percentage=leftover_running_percentage,
+        leftover_closed_percentage=leftover_closed_percentage,
+        closed_percentage=closed_percentage,
+        brand_specific_provision=brand_specific_provision or {},
+        unknown_season_in_bucket1=unknown_season_in_bucket1
+    )
+    fingerprint = run_digest((_input_digest(mapping), _input_digest(combinations)), parameters)
+
+    with trace.stage("read") as record:
+        soh = keyed_soh(read_workbook(soh_path, "soh", use_cache=use_cache))
+        mapping = read_workbook(mapping, "mapping", use_cache=use_cache)
+        combinations = read_workbook(combinations, "combinations", use_cache=use_cache)
+        mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
+        record["rows"] = len(soh)
+
+    with trace.stage("state_read") as record:
+        state = load_state(state_dir)
+        record["rows"] = len(state["provision"]) if state is not None else 0
+    results = None
+    if state is not None and state["meta"]["fingerprint"] == fingerprint:
+        results = _incremental_run(soh, mapping, combinations, state, parameters, trace)
+    if results is None:
+        results = _full_run(soh, mapping, combinations, parameters, trace)
+        previous_cube = fill_missing_zero(state["cube"]) if state is not None else results["cube"].iloc[:0]
+        results["segment_delta"] = _segment_delta(
+            _segment_totals(results["cube"]).sub(_segment_totals(previous_cube), fill_value=0))
+        if state is not None:
+            results["removed_rows"] = int((~state["rows"][ROW_HASH].isin(soh[ROW_HASH].to_numpy())).sum())
+
+    with trace.stage("state_write") as record:
+        save_state(state_dir, {
+            "fingerprint": fingerprint,
+            "buckets": _bucket_sets(results.pop("buckets")),
+            "rows": len(soh),
+            "updated": datetime.now(timezone.utc).isoformat(),
+        }, soh[ROW_HASH].to_numpy(), results["soh_comb"], results["cube"])
+        record["rows"] = len(results["soh_comb"])
+
+    results["soh_comb"] = results["soh_comb"].drop(columns=[OCCURRENCE, ROW_HASH])
+    if trace is not NO_TRACE:
+        results["trace"] = trace.to_frame()
+    return results
+
+def _segment_delta(delta):
+    delta = delta[delta.abs() > 1e-9]
+    return delta.reset_index()
+
+def _full_run(soh, mapping, combinations, parameters, trace):
+    prepared = prepare_aging_inputs(soh, mapping, combinations, use_cache=False, trace=trace)
+    results = apply_provision_parameters(prepared, **parameters, trace=trace)
+    results["buckets"] = _buckets_for(prepared["soh"]['std_season'].dropna().unique(), parameters)
+    results["mode"] = "full"
+    results["changed_rows"] = len(soh)
+    results["removed_rows"] = 0
+    return results
+
+def _incremental_run(soh, mapping, combinations, state, parameters, trace):
+    with trace.stage("diff") as record:
+        changed = ~soh[ROW_HASH].isin(state["rows"][ROW_HASH].to_numpy())
+        removed_rows = int((~state["rows"][ROW_HASH].isin(soh[ROW_HASH].to_numpy())).sum())
+        provision = state["provision"]
+        kept = provision[ROW_HASH].isin(soh[ROW_HASH].to_numpy()).to_numpy()
+        record["rows"] = int(changed.sum())
+
+    new_rows = filter_soh(soh[changed], mapping, trace)
+    seasons = set(new_rows['std_season'].dropna().unique()) | set(provision.loc[kept, 'std_season'].dropna().unique())
+    buckets = _buckets_for(seasons, parameters)
+    if _bucket_sets(buckets) != state["meta"]["buckets"]:
+        # a season appeared or disappeared, which moves rows between buckets everywhere
+        return None
+
+    compute_provision(new_rows, buckets, parameters['damage_percentage'], parameters['leftover_running_percentage'],
+                      parameters['leftover_closed_percentage'], parameters['closed_percentage'],
+                      parameters['brand_specific_provision'], trace)
+    with trace.stage("combinations_attach") as record:
+        new_rows = combinations_lookup(combinations).attach(new_rows)
+        soh_comb = _concat_aligned(provision[kept].copy(), new_rows.copy())
+        unmatched = _unmatched(soh_comb, mapping, combinations)
+        soh_comb = compact_frame(fill_missing_zero(soh_comb))
+        record["rows"] = len(soh_comb)
+
+    with trace.stage("aggregation") as record:
+        # rows of the previous run that are gone or replaced come out, new and changed rows go in
+        changes = [_negated(build_aggregate_cube(fill_missing_zero(provision[~kept].copy())))] if not kept.all() else []
+        if len(new_rows):
+            changes.append(build_aggregate_cube(fill_missing_zero(new_rows)))
+        cube = fill_missing_zero(state["cube"])
+        segment_delta = _segment_delta(_segment_totals(cube.iloc[:0]))
+        if changes:
+            movement = merge_cubes(changes)
+            cube = merge_cubes([cube, movement])
+            cube = cube[cube[CUBE_ROW_COUNT] != 0].reset_index(drop=True)
+            segment_delta = _segment_delta(_segment_totals(movement))
+        summary = brand_summary(cube.groupby(by='Std Brand', observed=True)[SUMMARY_COLUMNS].sum())
+        record["rows"] = len(cube)
+
+    return {
+        "summary": summary,
+        "soh_comb": soh_comb,
+        "cube": cube,
+        "mapping": mapping,
+        "unmatched": unmatched,
+        "buckets": buckets,
+        "mode": "incremental",
+        "changed_rows": int(changed.sum()),
+        "removed_rows": removed_rows,
+        "segment_delta": segment_delta,
+    }
@@ -0,0 +1,283 @@
+import hashlib
+import os
+import uuid
+import pandas as pd
+
+# Uploaded workbooks are converted once into a columnar file named after their content hash;
+# later runs reload that file instead of parsing the xlsx cell by cell.
+CACHE_DIR = os.path.join("Output", "cache")
+CACHE_VERSION = "v1"
+# least recently used cache files beyond this count are deleted
+CACHE_MAX_FILES = int(os.getenv("PROVISION_CACHE_FILES", "24"))
+
+def file_digest(source):
+    # content hash of an uploaded file or a path, used as the cache key of the prepared inputs
+    digest = hashlib.sha256()
+    if hasattr(source, "getvalue"):
+        digest.update(source.getvalue())
+    else:
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def frame_digest(df):
+    # content hash of an already parsed frame (column names and values)
+    digest = hashlib.sha256(repr(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def dedupe_combinations(combinations: pd.DataFrame) -> pd.DataFrame:
+    return combinations.groupby(['LOCATION', 'Std Brand']).first().reset_index()
+
+def _cache_path(kind, key, ext):
+    return os.path.join(CACHE_DIR, f"{kind}-{CACHE_VERSION}-{key}.{ext}")
+
+def _partial_path(path):
+    # private name the file is written under before os.replace moves it to path, so readers
+    # (and other writers of the same path) never see a partly written file
+    return f"{path}.{uuid.uuid4().hex}.part"
+
+def _write_atomic(write, path):
+    partial = _partial_path(path)
+    try:
+        write(partial)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
+
+def _arrow_cannot_type(error):
+    # no pyarrow, or an Arrow conversion error; I/O errors such as a full disk are not
+    if isinstance(error, ImportError):
+        return True
+    import pyarrow as pa
+    return isinstance(error, (pa.ArrowTypeError, pa.ArrowInvalid, pa.ArrowNotImplementedError))
+
+def write_frame(df, path):
+    # parquet at path; falls back to a pickle next to it (same name, .pkl) when Arrow cannot type it
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        return _write_atomic(lambda partial: df.to_parquet(partial, index=False), path)
+    except Exception as e:
+        # object columns mixing text and numbers that Arrow cannot type; a pickle keeps the
+        # values exactly as read_excel returned them
+        if not _arrow_cannot_type(e):
+            raise
+    return _write_atomic(df.to_pickle, os.path.splitext(path)[0] + ".pkl")
+
+def read_frame(path, columns=None):
+    # reads what write_frame wrote to path; None when neither file exists
+    if os.path.exists(path):
+        if columns is not None:
+            import pyarrow.parquet as pq
+            names = pq.read_schema(path).names
+            columns = [c for c in columns if c in names]
+        return pd.read_parquet(path, columns=columns)
+    path = os.path.splitext(path)[0] + ".pkl"
+    if os.path.exists(path):
+        df = pd.read_pickle(path)
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
+    return None
+
+def evict_files(directory, max_files):
+    # keeps the max_files most recently used files of directory (by mtime, which readers
+    # refresh) and deletes the rest; files still being written are left alone
+    try:
+        names = [n for n in os.listdir(directory) if not n.endswith(".part")]
+    except FileNotFoundError:
+        return
+    paths = [os.path.join(directory, n) for n in names]
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except FileNotFoundError:
+            pass
+    for path in sorted(mtimes, key=mtimes.get, reverse=True)[max_files:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def _write_cache(df, kind, key):
+    write_frame(df, _cache_path(kind, key, "parquet"))
+    evict_files(CACHE_DIR, CACHE_MAX_FILES)
+
+def _read_cache(kind, key, columns=None):
+    path = _cache_path(kind, key, "parquet")
+    df = read_frame(path, columns=columns)
+    if df is not None:
+        _touch(path if os.path.exists(path) else os.path.splitext(path)[0] + ".pkl")
+    return df
+
+def read_workbook(source, kind, columns=None, use_cache=True):
+    # kind is "soh", "mapping" or "combinations"; combinations are stored already deduplicated.
+    # columns prunes the read to what the caller needs (missing names are skipped).
+    # An already parsed DataFrame is accepted too and returned as a copy (deduplicated like
+    # every other combinations source). Sources are xlsx unless their name ends in .csv,
+    # .csv.gz or .parquet; parquet is read directly, uncached.
+    if isinstance(source, pd.DataFrame):
+        df = dedupe_combinations(source) if kind == "combinations" else source.copy()
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return df
+
+    if _source_name(source).endswith(".parquet"):
+        df = read_frame(source, columns=columns) if isinstance(source, (str, os.PathLike)) else pd.read_parquet(source)
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return dedupe_combinations(df) if kind == "combinations" else df
+
+    if use_cache:
+        key = file_digest(source)
+        cached = _read_cache(kind, key, columns=columns)
+        if cached is not None:
+            return cached
+
+    df = _read_source(source)
+    if kind == "combinations":
+        df = dedupe_combinations(df)
+    if use_cache:
+        _write_cache(df, kind, key)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+def _source_name(source):
+    return str(getattr(source, "name", source)).lower()
+
+def _read_source(source):
+    name = _source_name(source)
+    if name.endswith(".csv") or name.endswith(".csv.gz"):
+        return pd.read_csv(source)
+    # the xlsx engine is only imported here, on a cache miss
+    return pd.read_excel(source)
+
+def iter_workbook_chunks(source, chunksize=200_000, columns=None):
+    # Yields the SOH as DataFrames of at most chunksize rows without holding the whole file:
+    # Parquet by row batch, CSV through read_csv chunks, xlsx through openpyxl's read-only
+    # row iterator (or its Parquet cache, when an earlier run already converted it).
+    name = _source_name(source)
+    if name.endswith(".parquet"):
+        yield from _iter_parquet_chunks(source, chunksize, columns)
+        return
+    if name.endswith(".csv") or name.endswith(".csv.gz"):
+        usecols = (lambda c: c in columns) if columns is not None else None
+        yield from pd.read_csv(source, chunksize=chunksize, usecols=usecols)
+        return
+
+    cached = _cache_path("soh", file_digest(source), "parquet")
+    if os.path.exists(cached):
+        yield from _iter_parquet_chunks(cached, chunksize, columns)
+        return
+
+    import openpyxl
+    if hasattr(source, "seek"):
+        source.seek(0)
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        keep = [i for i, h in enumerate(header) if columns is None or h in columns]
+        names = [header[i] for i in keep]
+        buffer = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            buffer.append([row[i] if i < len(row) else None for i in keep])
+            if len(buffer) == chunksize:
+                yield pd.DataFrame(buffer, columns=names)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=names)
+    finally:
+        wb.close()
+
+def _iter_parquet_chunks(path, chunksize, columns):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(path)
+    if columns is not None:
+        columns = [c for c in columns if c in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
+
+# Output files are built on request and kept under the hash of the run that produced them,
+# so repeated downloads (and reruns) of the same result reuse the file on disk. Only the most
+# recently used EXPORT_MAX_FILES are kept.
+EXPORT_DIR = os.path.join("Output", "exports")
+EXPORT_MAX_FILES = int(os.getenv("PROVISION_EXPORT_FILES", "12"))
+EXPORT_FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+    "csv.gz": "application/gzip",
+}
+EXCEL_MAX_ROWS = 1_048_576
+
+def run_digest(input_keys, parameters):
+    # hash of the input file digests and parameters identifying one provision run
+    normalized = sorted((k, sorted(v.items()) if isinstance(v, dict) else v) for k, v in parameters.items())
+    return hashlib.sha256(repr((tuple(input_keys), normalized)).encode()).hexdigest()
+
+def write_xlsx_streaming(df, path, sheet_name="Sheet1"):
+    # xlsxwriter in constant_memory mode flushes each row as it is written, so the workbook
+    # never holds more than one row; pandas' to_excel writes column by column and cannot use it
+    if len(df) + 1 > EXCEL_MAX_ROWS:
+        raise ValueError(f"{len(df):,} rows do not fit in one Excel sheet, export as parquet or csv.gz")
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(path, {
+        'constant_memory': True,
+        'nan_inf_to_errors': True,
+        'default_date_format': 'yyyy-mm-dd',
+    })
+    try:
+        worksheet = workbook.add_worksheet(sheet_name)
+        bold = workbook.add_format({'bold': True})
+        worksheet.write_row(0, 0, [str(c) for c in df.columns], bold)
+        for row_number, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_number, 0, [None if v is pd.NaT else v for v in row])
+    finally:
+        workbook.close()
+
+def _arrow_compatible(df):
+    # Arrow needs one type per column; the zero fill leaves 0 among text values, written as "0"
+    df = df.copy(deep=False)
+    for col in df.columns:
+        values = df[col]
+        categorical = isinstance(values.dtype, pd.CategoricalDtype)
+        if not categorical and values.dtype != object:
+            continue
+        inferred = pd.api.types.infer_dtype(values.cat.categories if categorical else values, skipna=True)
+        if inferred.startswith("mixed"):
+            df[col] = values.astype(str)
+    df.columns = [str(c) for c in df.columns]
+    return df
+
+def export_frame(df, run_key, name, fmt="xlsx"):
+    # path of <name> for this run in the requested format, written only the first time
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {sorted(EXPORT_FORMATS)}")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{name}-{run_key}.{fmt}")
+    if os.path.exists(path):
+        _touch(path)
+        return path
+
+    if fmt == "xlsx":
+        write = lambda partial: write_xlsx_streaming(df, partial)
+    elif fmt == "parquet":
+        write = lambda partial: _arrow_compatible(df).to_parquet(partial, index=False)
+    else:
+        write = lambda partial: df.to_csv(partial, index=False, compression="gzip")
+    _write_atomic(write, path)
+    evict_files(EXPORT_DIR, EXPORT_MAX_FILES)
+    return path
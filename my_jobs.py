@@ -0,0 +1,199 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import pandas as pd
+from my_funct import prepare_aging_inputs, apply_provision_parameters, get_GL_entry
+from my_trace import PipelineTrace
+
+# Background runs for the dashboard. One executor is shared by every session of the app:
+# identical runs (same input hashes and parameters) share one job, finished results are kept
+# for the next rerun, and a run nobody is waiting for any more is cancelled.
+#
+# Jobs run in threads rather than processes: the parsed inputs and the row-level results stay
+# in this process for the UI and the exports, and pandas releases the GIL in the heavy parts
+# (merges, groupbys, numpy arithmetic). Because of that, finished results and shared inputs
+# are kept within a memory budget as well as a count: the least recently used go first.
+
+# stages a provision run reports (prepare: 6, provisioning: 4), used for the progress bar
+PROVISION_STAGES = 10
+
+def result_bytes(value):
+    # memory held by the frames of a result (nested dicts included); other values count as 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        return sum(result_bytes(v) for v in value.values())
+    return 0
+
+class JobCancelled(Exception):
+    pass
+
+class JobTrace(PipelineTrace):
+    # stage boundaries double as progress reports and cancellation points: a cancelled job
+    # stops when it enters its next stage
+    def __init__(self, cancel_event, track_memory=False):
+        super().__init__(track_memory=track_memory)
+        self.cancel_event = cancel_event
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        if self.cancel_event.is_set():
+            raise JobCancelled(name)
+        self.current = name
+        with super().stage(name) as record:
+            yield record
+
+class Job:
+    def __init__(self, key, expected_stages=1, track_memory=False):
+        self.key = key
+        self.id = uuid.uuid4().hex
+        self.expected_stages = expected_stages
+        self.cancel_event = threading.Event()
+        self.trace = JobTrace(self.cancel_event, track_memory)
+        self.owners = set()
+        self.future = None
+        self._bytes = None
+
+    def done(self):
+        return self.future.done()
+
+    @property
+    def status(self):
+        if self.future.cancelled() or self.cancel_event.is_set():
+            return "cancelled"
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        return "failed" if self.future.exception() is not None else "done"
+
+    def progress(self):
+        if self.future.done():
+            return 1.0
+        return min(len(self.trace.records) / max(self.expected_stages, 1), 0.99)
+
+    def result(self):
+        return self.future.result()
+
+    def result_bytes(self):
+        # size of the finished result, measured once; failed and cancelled jobs hold none
+        if self._bytes is None:
+            self._bytes = result_bytes(self.future.result()) if self.status == "done" else 0
+        return self._bytes
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.future.cancel()
+
+class JobExecutor:
+    def __init__(self, max_workers=2, max_finished=8, max_shared=4, max_finished_mb=2048, max_shared_mb=2048):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="provision-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._shared = OrderedDict()
+        self.max_finished = max_finished
+        self.max_shared = max_shared
+        self.max_finished_bytes = max_finished_mb * 2**20
+        self.max_shared_bytes = max_shared_mb * 2**20
+
+    def submit(self, key, fn, *args, owner=None, expected_stages=1, prepare=None, track_memory=False, **kwargs):
+        # fn(*args, trace=job.trace, **kwargs) runs once per key; later submits of the same key
+        # (from any session) get the running or finished job. Failed and cancelled jobs are retried.
+        # prepare, when given, maps args to what fn gets and is only called when a job starts
+        # (e.g. to copy uploads that must outlive the caller). track_memory is passed to the job's
+        # trace, so it belongs in key.
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.status in ("failed", "cancelled"):
+                job = Job(key, expected_stages, track_memory)
+                if prepare is not None:
+                    args = prepare(*args)
+                job.future = self._pool.submit(fn, *args, trace=job.trace, **kwargs)
+                job.future.add_done_callback(lambda _, trace=job.trace: trace.stop())
+                self._jobs[key] = job
+                self._evict_finished()
+            self._jobs.move_to_end(key)
+            if owner is not None:
+                job.owners.add(owner)
+            return job
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def release(self, key, owner):
+        # owner no longer waits for key; an unfinished job nobody waits for is cancelled
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.owners.discard(owner)
+            if not job.owners and not job.done():
+                job.cancel()
+                del self._jobs[key]
+
+    def _evict_finished(self):
+        finished = [key for key, job in self._jobs.items() if job.done()]
+        sizes = [self._jobs[key].result_bytes() for key in finished]
+        for key in _over_budget(finished, sizes, self.max_finished, self.max_finished_bytes):
+            del self._jobs[key]
+
+    def _evict_shared(self):
+        ready = [key for key, entry in self._shared.items() if entry["ready"].is_set()]
+        sizes = [self._shared[key]["bytes"] for key in ready]
+        for key in _over_budget(ready, sizes, self.max_shared, self.max_shared_bytes):
+            del self._shared[key]
+
+    def shared(self, key, fn, *args, **kwargs):
+        # fn(*args, **kwargs) computed once per key and kept for later jobs (the parsed inputs
+        # several parameter runs start from). Concurrent callers wait for the first one; if it
+        # fails or is cancelled, the next waiter computes it itself.
+        while True:
+            with self._lock:
+                entry = self._shared.get(key)
+                owner = entry is None
+                if owner:
+                    entry = self._shared[key] = {"ready": threading.Event(), "value": None, "failed": False,
+                                                 "bytes": 0}
+                elif key in self._shared:
+                    self._shared.move_to_end(key)
+            if owner:
+                try:
+                    entry["value"] = fn(*args, **kwargs)
+                    entry["bytes"] = result_bytes(entry["value"])
+                except BaseException:
+                    entry["failed"] = True
+                    with self._lock:
+                        if self._shared.get(key) is entry:
+                            del self._shared[key]
+                    raise
+                finally:
+                    entry["ready"].set()
+                with self._lock:
+                    self._evict_shared()
+                return entry["value"]
+            entry["ready"].wait()
+            if not entry["failed"]:
+                return entry["value"]
+
+def _over_budget(keys, sizes, max_count, max_bytes):
+    # keys (least recently used first) that do not fit in max_count entries and max_bytes;
+    # the most recent one is always kept, even when it alone exceeds max_bytes
+    evicted, count, total = [], 0, 0
+    for key, size in reversed(list(zip(keys, sizes))):
+        if evicted or (count and (count >= max_count or total + size > max_bytes)):
+            evicted.append(key)
+            continue
+        count += 1
+        total += size
+    return evicted
+
+def provision_job(executor, input_keys, soh, mapping, combinations, parameters, trace=None):
+    # the dashboard's provision run: parsed inputs shared per input hash, then the parameter stage
+    prepared = executor.shared(("prepare",) + tuple(input_keys), prepare_aging_inputs,
+                               soh, mapping, combinations, trace=trace)
+    return apply_provision_parameters(prepared, **parameters, trace=trace)
+
+def gl_entry_job(cube, balance_file, trace=None):
+    return get_GL_entry(cube, pd.read_excel(balance_file), trace)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from my_io import frame_digest
+
+# Reference tables (mapping, combinations) indexed once per file version and attached to SOH
+# rows through integer codes instead of a pandas merge. Key values are coded against each key
+# column's distinct values, the codes are combined into one integer per row and looked up in
+# the table's sorted codes. Results match a left merge: same row order, one output row per
+# matching table row (so duplicated keys repeat the SOH row) and NaN for unmatched rows.
+
+class LookupTable:
+    def __init__(self, table, keys):
+        self.keys = list(keys)
+        table = table.reset_index(drop=True)
+        self.columns = [c for c in table.columns if c not in self.keys]
+        self.levels = [pd.Index(pd.unique(table[key])) for key in self.keys]
+        codes = self._codes(table)
+        self._order = np.argsort(codes, kind='stable')
+        self._sorted_codes = codes[self._order]
+        self.duplicated = bool((np.diff(self._sorted_codes) == 0).any())
+        # looked-up columns are kept as integer codes over their distinct values (text) or as
+        # plain arrays (numbers)
+        self._values = {}
+        for col in self.columns:
+            if pd.api.types.is_numeric_dtype(table[col]):
+                self._values[col] = (None, table[col].to_numpy())
+            else:
+                value_codes, uniques = pd.factorize(table[col])
+                self._values[col] = (uniques, value_codes)
+
+    def _codes(self, frame):
+        # one int64 per row combining the key columns; -1 when any key value is not in the table
+        combined = np.zeros(len(frame), dtype=np.int64)
+        missing = np.zeros(len(frame), dtype=bool)
+        for key, level in zip(self.keys, self.levels):
+            column = frame[key]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                row_codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+            else:
+                row_codes, uniques = pd.factorize(column)
+            # NaN gets its own slot so it matches a NaN key in the table, as merge does
+            na_slot = np.flatnonzero(pd.isna(level))[:1]
+            level_codes = np.append(level.get_indexer(uniques), na_slot if len(na_slot) else -1)[row_codes]
+            missing |= level_codes < 0
+            combined = combined * len(level) + level_codes
+        combined[missing] = -1
+        return combined
+
+    def match(self, frame):
+        # (rows, positions): frame row and table row of each output row; rows is None when
+        # every frame row has at most one match, positions is -1 for unmatched rows
+        codes = self._codes(frame)
+        left = np.searchsorted(self._sorted_codes, codes, side='left')
+        right = np.searchsorted(self._sorted_codes, codes, side='right')
+        counts = np.where(codes < 0, 0, right - left)
+        if not len(self._order):
+            return None, np.full(len(frame), -1)
+        if not self.duplicated:
+            return None, np.where(counts > 0, self._order[np.minimum(left, len(self._order) - 1)], -1)
+        repeats = np.maximum(counts, 1)
+        rows = np.repeat(np.arange(len(frame)), repeats)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        matched = np.repeat(counts > 0, repeats)
+        positions = np.where(matched, self._order[np.minimum(np.repeat(left, repeats) + offsets,
+                                                             len(self._order) - 1)], -1)
+        return rows, positions
+
+    def values(self, col, positions):
+        uniques, values = self._values[col]
+        found = positions >= 0
+        if not found.any():
+            values, positions = np.zeros(1, dtype=values.dtype), np.zeros_like(positions)
+        if uniques is not None:
+            return pd.Categorical.from_codes(np.where(found, values[positions], -1), categories=uniques)
+        if found.all():
+            return values[positions]
+        return np.where(found, values[positions].astype(float), np.nan)
+
+    def frame(self, positions):
+        return pd.DataFrame({col: self.values(col, positions) for col in self.columns})
+
+    def attach(self, frame, value=None):
+        # frame with the table's columns added (RangeIndex, like merge); with value set, also
+        # the unmatched keys with their row count and total of that column
+        rows, positions = self.match(frame)
+        if rows is not None:
+            frame = frame.take(rows)
+        frame = frame.reset_index(drop=True)
+        for col in self.columns:
+            frame[col] = self.values(col, positions)
+        if value is None:
+            return frame
+        return frame, unmatched_keys(frame[positions < 0], self.keys, value)
+
+def unmatched_keys(frame, keys, value):
+    return (frame.groupby(keys, observed=True, dropna=False, sort=False)[value]
+            .agg(rows='size', total='sum').rename(columns={'total': value})
+            .sort_values(value, ascending=False).reset_index())
+
+def merge_unmatched(frames, keys, value):
+    # unmatched-key reports of several chunks -> one report
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=keys + ['rows', value])
+    merged = pd.concat(frames, ignore_index=True)
+    merged = merged.groupby(keys, observed=True, dropna=False, sort=False)[['rows', value]].sum()
+    return merged.sort_values(value, ascending=False).reset_index()
+
+# built tables, by kind and content hash of the reference frame: a few KB each, and the
+# frames themselves are already persisted per file version in the parquet input cache
+_lookup_cache = {}
+
+def _lookup(kind, table, keys):
+    key = (kind, frame_digest(table))
+    if key not in _lookup_cache:
+        _lookup_cache[key] = LookupTable(table, keys)
+    return _lookup_cache[key]
+
+def mapping_lookup(mapping):
+    mapping = mapping.copy()
+    mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
+    return _lookup("mapping", mapping, ['GROUP_NAME'])
+
+def combinations_lookup(combinations):
+    return _lookup("combinations", combinations, ['Std Brand', 'LOCATION'])
+
+def upper_categories(column):
+    # column.str.upper() computed once per distinct value, returned as a categorical
+    codes, uniques = pd.factorize(column)
+    upper_codes, upper_uniques = pd.factorize(pd.Series(uniques, dtype=object).str.upper())
+    return pd.Categorical.from_codes(np.where(codes >= 0, np.append(upper_codes, -1)[codes], -1),
+                                     categories=upper_uniques)
@@ -0,0 +1,192 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from my_funct import (SOH_COLUMNS, SUMMARY_COLUMNS, filter_soh, season_buckets, compute_provision,
+                      fill_missing_zero, compact_frame, build_aggregate_cube, merge_cubes, brand_summary,
+                      season_column, CUBE_KEYS)
+from my_io import read_workbook, _arrow_cannot_type
+from my_lookup import mapping_lookup, combinations_lookup, upper_categories, merge_unmatched
+from my_trace import NO_TRACE
+
+# Partitioned provision run over a process pool. The SOH is read once in the parent, split into
+# partitions (whole Std Brands, or plain row ranges) and written to one Arrow IPC file that every
+# worker memory-maps, so a partition reaches its worker as a slice of shared pages rather than a
+# pickled copy. Each worker provisions its partitions and returns only their aggregate cubes.
+#
+# The std_season values that fix the bucket boundaries are collected in the parent first, on
+# the few columns the filter reads. Brand partitions give exactly the serial results, since every
+# cube row is summed over the same rows in the same order; row ranges split brands across
+# workers and match to floating point rounding (as do brands sharing a GROUP_NAME in the mapping,
+# whose rows all go with the first of them).
+
+PARTITION_MODES = ("brand", "rows")
+FIRST_ROW = '_first_row'
+
+# mapping, combinations and the partition file, set once per worker by the pool initializer
+_shared = {}
+
+def _init_worker(mapping, combinations, path):
+    _shared["mapping"] = mapping
+    _shared["combinations"] = combinations
+    _shared["path"] = path
+    _shared["table"] = None
+
+def _partition(start, stop):
+    if _shared["path"].endswith(".pkl"):
+        # one pickle per partition, numbered by start
+        return pd.read_pickle(_shared["path"].format(start))
+    if _shared.get("table") is None:
+        import pyarrow as pa
+        _shared["table"] = pa.ipc.open_file(pa.memory_map(_shared["path"], "r")).read_all()
+    return _shared["table"].slice(start, stop - start).to_pandas()
+
+def _write_partitions(soh, bounds, directory):
+    # one Arrow file sliced by row range; object columns Arrow cannot type (text mixed with
+    # numbers) fall back to one pickle per partition, so a worker only loads the ones it runs
+    path = os.path.join(directory, "soh.arrow")
+    try:
+        import pyarrow as pa
+        table = pa.Table.from_pandas(soh, preserve_index=False)
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        return path, bounds
+    except Exception as e:
+        if not _arrow_cannot_type(e):
+            raise
+    path = os.path.join(directory, "soh-{}.pkl")
+    for number, (start, stop) in enumerate(bounds):
+        soh.iloc[start:stop].to_pickle(path.format(number))
+    return path, [(number, number + 1) for number in range(len(bounds))]
+
+def partition_bounds(soh, mapping, partitions, partition_by="brand"):
+    # (soh ordered so each partition is one row range, [(start, stop), ...]); rows keep their
+    # original order within a partition, and their original position in FIRST_ROW
+    soh = soh.reset_index(drop=True)
+    soh[FIRST_ROW] = np.arange(len(soh))
+    if partition_by == "rows":
+        edges = np.linspace(0, len(soh), min(partitions, max(len(soh), 1)) + 1).astype(int)
+        return soh, [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+    if partition_by != "brand":
+        raise ValueError(f"Unknown partition mode {partition_by!r}, expected one of {PARTITION_MODES}")
+
+    # brands placed largest first on the partition with the fewest rows so far
+    lookup = mapping_lookup(mapping)
+    frame = pd.DataFrame({'GROUP_NAME': upper_categories(soh['GROUP_NAME'])})
+    rows, positions = lookup.match(frame)
+    if rows is not None:
+        # a GROUP_NAME repeated in the mapping goes with its first Std Brand, one code per SOH row
+        positions = positions[np.flatnonzero(np.diff(rows, prepend=-1))]
+    brand_codes, _ = pd.factorize(lookup.values('Std Brand', positions), use_na_sentinel=False)
+    sizes = np.bincount(brand_codes)
+    loads = np.zeros(min(partitions, len(sizes)) or 1, dtype=np.int64)
+    partition_of = np.zeros(len(sizes), dtype=np.int64)
+    for brand in np.argsort(-sizes, kind='stable'):
+        partition_of[brand] = np.argmin(loads)
+        loads[partition_of[brand]] += sizes[brand]
+    row_partition = partition_of[brand_codes]
+    soh = soh.take(np.argsort(row_partition, kind='stable')).reset_index(drop=True)
+    edges = np.concatenate([[0], np.cumsum(np.bincount(row_partition, minlength=len(loads)))])
+    return soh, [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+def _provision_partition(start, stop, buckets, parameters):
+    unmatched = {}
+    soh = filter_soh(_partition(start, stop), _shared["mapping"], unmatched=unmatched)
+    compute_provision(soh, buckets, parameters['damage_percentage'], parameters['leftover_running_percentage'],
+                      parameters['leftover_closed_percentage'], parameters['closed_percentage'],
+                      parameters['brand_specific_provision'])
+    soh_comb, missing = combinations_lookup(_shared["combinations"]).attach(soh, value='NETTOTAL_COST')
+    soh_comb = compact_frame(fill_missing_zero(soh_comb))
+    cube = build_aggregate_cube(soh_comb)
+    # original position of each cube row's first SOH row, to restore the serial cube order
+    groups = soh_comb.groupby(CUBE_KEYS + [season_column(soh_comb)], observed=True, dropna=False, sort=False).ngroup()
+    cube[FIRST_ROW] = soh_comb[FIRST_ROW].to_numpy()[np.unique(groups.to_numpy(), return_index=True)[1]]
+    return cube, unmatched["mapping"], missing, len(soh_comb)
+
+def run_aging_provision_pipeline_parallel(
+    soh_path,
+    mapping,
+    combinations,
+    first_first_bucket_number_seasons=5,
+    damage_percentage=1.0,
+    leftover_running_percentage=0.15,
+    leftover_closed_percentage=0.5,
+    closed_percentage=0.5,
+    brand_specific_provision=None,
+    unknown_season_in_bucket1=True,
+    workers=None,
+    partition_by="brand",
+    partitions=None,
+    use_cache=True,
+    trace=None
+):
+    # Same results as run_aging_provision_pipeline_chunked (summary, cube, mapping, rows,
+    # unmatched). workers defaults to the CPU count; partitions to twice the workers, so a
+    # large brand on one worker leaves the others room to pick up the rest.
+    trace = trace or NO_TRACE
+    workers = workers or os.cpu_count() or 1
+    parameters = dict(
+        damage_percentage=damage_percentage,
+        leftover_running_percentage=leftover_running_percentage,
+        leftover_closed_percentage=leftover_closed_percentage,
+        closed_percentage=closed_percentage,
+        brand_specific_provision=brand_specific_provision or {},
+    )
+
+    with trace.stage("read") as record:
+        soh = read_workbook(soh_path, "soh", columns=SOH_COLUMNS, use_cache=use_cache)
+        mapping = read_workbook(mapping, "mapping", use_cache=use_cache)
+        mapping['GROUP_NAME'] = mapping['GROUP_NAME'].str.upper()
+        combinations = read_workbook(combinations, "combinations", use_cache=use_cache)
+        record["rows"] = len(soh)
+    if combinations_lookup(combinations).duplicated:
+        raise ValueError("Combinations have more than one row for a Std Brand and LOCATION")
+
+    with trace.stage("season_scan") as record:
+        # text columns as categoricals from here on: a cheaper filter, and dictionary-encoded
+        # columns in the partition file
+        soh = compact_frame(soh)
+        scope_columns = ['GROUP_NAME', 'AR Comments', 'NETTOTAL_COST', season_column(soh)]
+        std_seasons = filter_soh(soh[[c for c in scope_columns if c in soh.columns]], mapping)['std_season'].dropna().unique()
+        record["rows"] = len(std_seasons)
+    buckets = season_buckets(sorted(std_seasons), first_first_bucket_number_seasons, unknown_season_in_bucket1)
+
+    with tempfile.TemporaryDirectory(prefix="provision-") as directory:
+        with trace.stage("partition") as record:
+            soh, bounds = partition_bounds(soh, mapping, partitions or 2 * workers, partition_by)
+            path, bounds = _write_partitions(soh, bounds, directory)
+            del soh
+            record["rows"] = len(bounds)
+        if not bounds:
+            raise ValueError("SOH file has no rows in scope")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(mapping, combinations, path)) as pool:
+            with trace.stage("partitions") as record:
+                outputs = list(pool.map(_provision_partition, *zip(*bounds), [buckets] * len(bounds),
+                                        [parameters] * len(bounds)))
+                record["rows"] = sum(rows for *_, rows in outputs)
+
+    with trace.stage("aggregation") as record:
+        cubes = [cube for cube, *_ in outputs if len(cube)]
+        if not cubes:
+            raise ValueError("SOH file has no rows in scope")
+        cube = pd.concat(cubes, ignore_index=True).sort_values(FIRST_ROW, kind='stable')
+        cube = merge_cubes([cube])
+        summary = brand_summary(cube.groupby(by='Std Brand', observed=True)[SUMMARY_COLUMNS].sum())
+        record["rows"] = len(cube)
+
+    results = {
+        "summary": summary,
+        "cube": cube,
+        "mapping": mapping,
+        "rows": sum(rows for *_, rows in outputs),
+        "unmatched": {
+            "mapping": merge_unmatched([m for _, m, _, _ in outputs], ['GROUP_NAME'], 'NETTOTAL_COST'),
+            "combinations": merge_unmatched([c for _, _, c, _ in outputs], ['Std Brand', 'LOCATION'], 'NETTOTAL_COST'),
+        },
+    }
+    if trace is not NO_TRACE:
+        results["trace"] = trace.to_frame()
+    return results
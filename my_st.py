@@ -1,8 +1,14 @@
 import streamlit as st
 import pandas as pd
-from my_funct import run_aging_provision_pipeline, get_GL_entry, get_analysis
+from my_funct import get_analysis, memory_report, run_sensitivity
+from my_io import EXPORT_FORMATS, export_frame, file_digest, run_digest
+from my_jobs import JobExecutor, PROVISION_STAGES, provision_job, gl_entry_job
+from my_trace import PipelineTrace
+from my_history import save_run, save_gl_entries, list_runs, compare_runs, COMPARE_KEYS
 import io
+import json
 import os
+import uuid
 #from dotenv import load_dotenv
 
 try:
@@ -47,7 +53,64 @@ st.success("✅ Logged in successfully!")
 os.makedirs("Output", exist_ok=True)
 brand_specific_provision = {}
 
-tab1, tab2, tab3 = st.tabs(["🧾 Provision Summary", "📊 Analysis", "📄 GL Entries"])
+# Runs happen in background jobs shared by all sessions: the same files and parameters are
+# computed once, and parsed inputs are reused across parameter changes (see my_jobs).
+@st.cache_resource
+def job_executor():
+    return JobExecutor(max_workers=int(os.getenv("PROVISION_JOB_WORKERS", "2")),
+                       max_finished_mb=int(os.getenv("PROVISION_JOB_RESULTS_MB", "2048")),
+                       max_shared_mb=int(os.getenv("PROVISION_JOB_INPUTS_MB", "2048")))
+
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+
+def detached(*args):
+    # jobs outlive the rerun that started them, so they get their own copy of each upload;
+    # only called when a job actually starts
+    return tuple(io.BytesIO(arg.getvalue()) if isinstance(arg, io.BytesIO) else arg for arg in args)
+
+def submit_job(slot, key, fn, *args, expected_stages=1, track_memory=False):
+    # one job per slot and session; moving a slot to a new key releases (and, if nobody else
+    # waits for it, cancels) the job it pointed to before. Runs with and without memory tracking
+    # are separate jobs.
+    key = (*key, track_memory)
+    executor = job_executor()
+    session_id = st.session_state["session_id"]
+    previous = st.session_state.get(slot)
+    if previous is not None and previous != key:
+        executor.release(previous, session_id)
+    st.session_state[slot] = key
+    return executor.submit(key, fn, *args, owner=session_id, expected_stages=expected_stages, prepare=detached,
+                           track_memory=track_memory)
+
+@st.fragment(run_every=1.0)
+def job_progress(job, label):
+    # polls the running job; a full rerun picks up the result once it is done
+    if job.done():
+        st.rerun()
+    st.progress(job.progress(), text=f"{label}: {job.trace.current or 'queued'}...")
+
+with st.sidebar:
+    st.subheader("🩺 Diagnostics")
+    record_trace = st.checkbox("Record stage timings")
+    track_memory = st.checkbox("Track Python memory per stage (slower)", disabled=not record_trace)
+    save_trace = st.checkbox("Append timings to Output/traces/pipeline_trace.jsonl", disabled=not record_trace)
+    st.markdown("---")
+track_memory = record_trace and track_memory
+trace = PipelineTrace(track_memory=track_memory) if record_trace else None
+
+def show_job_stages(slot, job):
+    # a job's stages are shown once, on the rerun that picks up its result; later reruns reuse
+    # the result without running them
+    if st.session_state.get(f"{slot}_shown") == job.id:
+        return
+    st.session_state[f"{slot}_shown"] = job.id
+    if trace is not None:
+        trace.records.extend(job.trace.records)
+run_key = None
+
+tab1, tab2, tab3, tab4, tab5 = st.tabs(["🧾 Provision Summary", "📊 Analysis", "📄 GL Entries", "📈 Sensitivity",
+                                        "🗂 Run History"])
 
 with tab1:
     st.markdown("""
@@ -108,23 +171,36 @@ with tab1:
         else:
             st.caption("Upload SOH file to enable brand override.")
         
+    results = None
     if soh_file and combinations_file and mapping_file:
-        with st.spinner("Running provision logic. Please wait..."):
-            results = run_aging_provision_pipeline(
-                soh_path=soh_file,
-                mapping=mapping_file,
-                combinations=combinations_file,
-                first_first_bucket_number_seasons=first_first_bucket_number_seasons,
-                damage_percentage=damage_percentage,
-                leftover_running_percentage=leftover_running_percentage,
-                leftover_closed_percentage=leftover_closed_percentage,
-                closed_percentage=closed_percentage,
-                brand_specific_provision=brand_specific_provision,
-                unknown_season_in_bucket1=unknown_season_in_bucket1
-            )
+        input_keys = (file_digest(soh_file), file_digest(mapping_file), file_digest(combinations_file))
+        parameters = dict(
+            first_first_bucket_number_seasons=first_first_bucket_number_seasons,
+            damage_percentage=damage_percentage,
+            leftover_running_percentage=leftover_running_percentage,
+            leftover_closed_percentage=leftover_closed_percentage,
+            closed_percentage=closed_percentage,
+            brand_specific_provision=brand_specific_provision,
+            unknown_season_in_bucket1=unknown_season_in_bucket1
+        )
+        run_key = run_digest(input_keys, parameters)
+        job = submit_job("provision_job", ("provision", run_key), provision_job, job_executor(), input_keys,
+                         soh_file, mapping_file, combinations_file, parameters,
+                         expected_stages=PROVISION_STAGES, track_memory=track_memory)
+        if not job.done():
+            job_progress(job, "Running provision logic")
+        elif job.status == "failed":
+            st.error(f"Provision run failed: {job.future.exception()}")
+        else:
+            results = job.result()
             st.session_state["soh_comb"] = results["soh_comb"]
+            st.session_state["cube"] = results["cube"]
+            st.session_state["cube_key"] = run_key
             st.session_state["mapping_data"] = results["mapping"]
+            st.session_state["unmatched"] = results.get("unmatched")
+            show_job_stages("provision_job", job)
 
+    if results is not None:
         st.success("Provisioning complete!")
 
         
@@ -151,18 +227,38 @@ with tab1:
         col4.metric("Total Provision", f"{total_provision:,.0f}")
         col5.metric("Avg Coverage %", f"{avg_coverage:.2f}%")
 
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            results["soh_comb"].to_excel(writer, index=False)
-        st.download_button("Download Combinations Output", data=buffer.getvalue(),
-                        file_name="aging_provision_combinations.xlsx")
+        # the file is only written when the button is clicked, and reused for the same run
+        export_format = st.radio("Output format", list(EXPORT_FORMATS), horizontal=True,
+                                 help="parquet and csv.gz are much faster to build than xlsx for large files")
+        soh_comb = results["soh_comb"]
+
+        def export_bytes():
+            with open(export_frame(soh_comb, run_key, "aging_provision_combinations", export_format), "rb") as f:
+                return f.read()
+
+        st.download_button("Download Combinations Output",
+                        data=export_bytes,
+                        file_name=f"aging_provision_combinations.{export_format}",
+                        mime=EXPORT_FORMATS[export_format])
+
+        if st.checkbox("Show memory usage of the working file"):
+            st.dataframe(memory_report(results["soh_comb"]).style.format({"bytes": "{:,.0f}", "MB": "{:,.2f}"}))
+
+        # saved runs are compared in the Run History tab without recomputing them
+        history_label = st.text_input("Run label", value=soh_file.name)
+        if st.button("💾 Save run to history"):
+            st.session_state["history_run"] = (run_key, save_run(results, parameters, history_label,
+                                                                 soh_file.name, run_key))
+        if st.session_state.get("history_run", (None,))[0] == run_key:
+            st.caption(f"Saved as run {st.session_state['history_run'][1]}")
 
 
 
 with tab2:
     #st.write("Debug - keys in session_state:", list(st.session_state.keys()))
-    if ("soh_comb" in st.session_state) and ('mapping_data' in st.session_state):
-        analysis = get_analysis(st.session_state["soh_comb"],st.session_state["mapping_data"])
+    if ("cube" in st.session_state) and ('mapping_data' in st.session_state):
+        analysis = get_analysis(st.session_state["cube"],st.session_state["mapping_data"], trace,
+                                st.session_state.get("unmatched"))
 
         def render_summary_with_metrics(title, df):
             st.subheader(title)
@@ -216,6 +312,15 @@ with tab2:
         st.subheader("")
         st.metric( "Total SOH cost with missing combinations",value=f"{analysis['missing_comb_rows']:,.2f}")      
 
+        if analysis["unmatched_group_names"] is not None:
+            col1, col2 = st.columns(2)
+            with col1:
+                st.subheader("GROUP_NAME not in the mapping file")
+                st.dataframe(analysis["unmatched_group_names"].astype({'GROUP_NAME': str}).style.format({"NETTOTAL_COST": "{:,.0f}"}), hide_index=True)
+            with col2:
+                st.subheader("Brand and location not in the combinations file")
+                st.dataframe(analysis["unmatched_combinations"].astype({'Std Brand': str, 'LOCATION': str}).style.format({"NETTOTAL_COST": "{:,.0f}"}), hide_index=True)
+
 
     else:
         st.warning("Run the provision logic in Tab 1 to view analysis.")
@@ -224,12 +329,19 @@ with tab3:
     st.markdown("Upload the existing balance file for reconciliation:")
     balance_file = st.file_uploader("Upload Existing Balance File", type=["xlsx"], key="balance")
 
-    if "soh_comb" in st.session_state and balance_file:
-        with st.spinner("Generating GL entries..."):
-            completed_entry, diff_entry ,existing_balances= get_GL_entry(
-                st.session_state["soh_comb"],
-                pd.read_excel(balance_file)
-            )
+    gl_job = None
+    if "cube" in st.session_state and balance_file:
+        gl_job = submit_job("gl_job", ("gl_entry", st.session_state.get("cube_key"), file_digest(balance_file)),
+                            gl_entry_job, st.session_state["cube"], balance_file, track_memory=track_memory)
+        if not gl_job.done():
+            job_progress(gl_job, "Generating GL entries")
+        elif gl_job.status == "failed":
+            st.error(f"GL entry generation failed: {gl_job.future.exception()}")
+        else:
+            show_job_stages("gl_job", gl_job)
+
+    if gl_job is not None and gl_job.status == "done":
+        completed_entry, diff_entry ,existing_balances= gl_job.result()
         st.metric("Total Provision amount(dr/(CR))", f"{completed_entry[completed_entry['s5']==23993]['Dr/(CR)'].sum():,.2f}")
         st.metric("Current balance the System (dr/(CR))", f"{existing_balances.iloc[:,-1].sum():,.2f}")
         st.metric("Diff entry(dr/(CR))", f"{diff_entry[diff_entry['s5']==23993]['Dr/(CR)'].sum():,.2f}")
@@ -243,8 +355,118 @@ with tab3:
         #st.dataframe(diff_entry)
         st.download_button("Download Diff Entry", data=diff_entry.to_csv(index=False).encode(),
                         file_name="diff_entry.csv")
+
+        saved_key, saved_run = st.session_state.get("history_run", (None, None))
+        if saved_key is not None and saved_key == st.session_state.get("cube_key"):
+            if st.button("💾 Store these GL entries with the saved run"):
+                save_gl_entries(saved_run, completed_entry, diff_entry)
+                st.caption(f"GL entries stored with run {saved_run}")
         
-    elif "soh_comb" not in st.session_state:
+    elif "cube" not in st.session_state:
         st.warning("Run the provision logic in Tab 1 first.")
     elif not balance_file:
-        st.info("Please upload a balance file to generate GL entries.")
\ No newline at end of file
+        st.info("Please upload a balance file to generate GL entries.")
+
+with tab4:
+    if "cube" in st.session_state:
+        st.markdown("Enter comma-separated values for each parameter; every combination is evaluated.")
+
+        def parse_grid(label, default, cast=float, bounds=None):
+            # bounds: (lowest, highest) allowed value, as in the sidebar input
+            text = st.text_input(label, value=default)
+            try:
+                values = [cast(v) for v in text.split(",") if v.strip()]
+            except ValueError:
+                st.error(f"Could not read the values for {label}")
+                st.stop()
+            if not values:
+                st.error(f"Enter at least one value for {label}")
+                st.stop()
+            if bounds is not None and not all(bounds[0] <= v <= bounds[1] for v in values):
+                st.error(f"Values for {label} must be between {bounds[0]} and {bounds[1]}")
+                st.stop()
+            return values
+
+        col1, col2 = st.columns(2)
+        with col1:
+            damage_grid = parse_grid("Damage Provision %", f"{damage_percentage}")
+            leftover_running_grid = parse_grid("Leftover - Running Brand %", f"{leftover_running_percentage}")
+            leftover_closed_grid = parse_grid("Leftover - Closed Brand %", f"{leftover_closed_percentage}")
+        with col2:
+            closed_grid = parse_grid("Closed Brand (Other) %", f"{closed_percentage}")
+            bucket_grid = parse_grid("Number of Seasons in Bucket 1", f"{first_first_bucket_number_seasons}", cast=int,
+                                     bounds=(1, 10))
+
+        sensitivity = run_sensitivity(
+            st.session_state["cube"],
+            first_first_bucket_number_seasons=bucket_grid,
+            damage_percentage=damage_grid,
+            leftover_running_percentage=leftover_running_grid,
+            leftover_closed_percentage=leftover_closed_grid,
+            closed_percentage=closed_grid,
+            brand_specific_provision=brand_specific_provision,
+            unknown_season_in_bucket1=unknown_season_in_bucket1
+        )
+        scenarios = sensitivity["scenarios"]
+        totals = sensitivity["results"].groupby(level="scenario")[
+            ["NETTOTAL_COST", "provision_amount_policy", "additional_provision", "Total Provision"]].sum()
+        totals = scenarios.join(totals)
+
+        st.subheader(f"Total Provision across {len(scenarios)} scenarios")
+        x_param = st.selectbox("Chart against", list(scenarios.columns), index=list(scenarios.columns).index("closed_percentage"))
+        st.scatter_chart(totals, x=x_param, y="Total Provision")
+        st.dataframe(totals.style.format({"NETTOTAL_COST": "{:,.0f}", "provision_amount_policy": "{:,.0f}",
+                                          "additional_provision": "{:,.0f}", "Total Provision": "{:,.0f}"}))
+
+        scenario = st.selectbox("Scenario for brand breakdown", list(scenarios.index))
+        by_brand = sensitivity["results"].xs(scenario, level="scenario")
+        by_brand.index = by_brand.index.astype(str)
+        st.bar_chart(by_brand["Total Provision"])
+    else:
+        st.warning("Run the provision logic in Tab 1 to run a sensitivity analysis.")
+
+with tab5:
+    runs = list_runs()
+    if len(runs) >= 2:
+        st.dataframe(runs[["label", "created", "source", "rows", "total_cost", "total_provision"]]
+                     .style.format({"total_cost": "{:,.0f}", "total_provision": "{:,.0f}"}))
+        run_names = lambda run_id: f"{runs.at[run_id, 'label']} ({run_id})"
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            run_a = st.selectbox("Run A", list(runs.index), index=1, format_func=run_names)
+        with col2:
+            run_b = st.selectbox("Run B", list(runs.index), index=0, format_func=run_names)
+        with col3:
+            compare_by = st.radio("Compare by", list(COMPARE_KEYS), horizontal=True)
+
+        compared = compare_runs(run_a, run_b, compare_by)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Total Provision A", f"{compared['Total Provision A'].sum():,.0f}")
+        col2.metric("Total Provision B", f"{compared['Total Provision B'].sum():,.0f}")
+        col3.metric("Change", f"{compared['Total Provision change'].sum():,.0f}")
+        compared.index = compared.index.map(str) if compared.index.nlevels == 1 else compared.index.map(lambda keys: " / ".join(map(str, keys)))
+        st.bar_chart(compared["Total Provision change"].head(30))
+        st.dataframe(compared.style.format("{:,.0f}"))
+
+        with st.expander("Parameters of both runs"):
+            st.dataframe(pd.DataFrame({side: json.loads(runs.at[run_id, "parameters"])
+                                       for side, run_id in (("A", run_a), ("B", run_b))}).astype(str))
+    else:
+        st.info("Save at least two runs from Tab 1 to compare them here.")
+
+# tabs 2 and 3 run after tab 1 on every rerun, so the panel is drawn last to include their stages
+if trace is not None:
+    trace.stop()
+    with st.sidebar:
+        with st.expander("Stage timings", expanded=True):
+            if trace.records:
+                stage_frame = trace.to_frame()
+                st.dataframe(stage_frame.style.format({"seconds": "{:,.3f}", "peak_mb": "{:,.1f}", "rss_start_mb": "{:,.1f}",
+                                                       "rss_end_mb": "{:,.1f}", "max_rss_mb": "{:,.1f}",
+                                                       "max_rss_increase_mb": "{:,.1f}"},
+                                                      na_rep=""), hide_index=True)
+                st.caption(f"Total {stage_frame['seconds'].sum():,.2f}s")
+                if save_trace:
+                    trace.write(os.path.join("Output", "traces", "pipeline_trace.jsonl"), run=run_key)
+            else:
+                st.caption("No pipeline stage ran on this rerun.")
@@ -0,0 +1,112 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def _rss_mb():
+    # current resident set size; read from /proc, so only available on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+# tracemalloc is process-wide while traces come and go per run, session and job: it runs while
+# any trace tracks memory and stops with the last one (unless it was already on before)
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+def _acquire_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            _tracemalloc_owned = not tracemalloc.is_tracing()
+            if _tracemalloc_owned:
+                tracemalloc.start()
+        _tracemalloc_users += 1
+
+def _release_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+
+class PipelineTrace:
+    # Wall time, row count and memory per pipeline stage. Pass one to
+    # run_aging_provision_pipeline / get_GL_entry / get_analysis through their trace argument.
+    # track_memory turns on tracemalloc to report the peak Python/numpy allocation of each
+    # stage; it slows the run down, so it is off by default. Traces running at the same time
+    # share tracemalloc, so their peaks include each other's allocations. RSS is always recorded: at stage
+    # entry and exit, the process peak after the stage, and how much the stage raised that peak.
+
+    def __init__(self, track_memory=False, enabled=True):
+        self.enabled = enabled
+        self.track_memory = track_memory and enabled
+        self.records = []
+        self._tracing = self.track_memory
+        if self._tracing:
+            _acquire_tracemalloc()
+
+    @contextmanager
+    def stage(self, name):
+        # the yielded dict is the stage record; callers add "rows" (or anything else) to it
+        record = {"stage": name}
+        if not self.enabled:
+            yield record
+            return
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        rss_start, max_rss_start = _rss_mb(), _max_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.track_memory:
+                record["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            record["rss_start_mb"] = rss_start
+            record["rss_end_mb"] = _rss_mb()
+            record["max_rss_mb"] = _max_rss_mb()
+            if max_rss_start is not None:
+                record["max_rss_increase_mb"] = record["max_rss_mb"] - max_rss_start
+            self.records.append(record)
+
+    def stop(self):
+        if self._tracing:
+            _release_tracemalloc()
+            self._tracing = False
+
+    def to_frame(self):
+        columns = ["stage", "rows", "seconds", "peak_mb", "rss_start_mb", "rss_end_mb", "max_rss_mb", "max_rss_increase_mb"]
+        frame = pd.DataFrame(self.records)
+        return frame.reindex(columns=columns + [c for c in frame.columns if c not in columns])
+
+    def write(self, path, **context):
+        # appends one JSON line per stage; context (run name, file, parameters...) is added to each
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        timestamp = datetime.now(timezone.utc).isoformat()
+        with open(path, "a") as f:
+            for record in self.records:
+                f.write(json.dumps({"timestamp": timestamp, **context, **record}, default=str) + "\n")
+
+# stand-in used when no trace is passed, so the pipeline can always write `with trace.stage(...)`
+NO_TRACE = PipelineTrace(enabled=False)